@@ -0,0 +1,79 @@
+'''
+Dependency cache of the analysis outputs.
+Each output file is recorded with a key, the hash of everything it was
+computed from: the content of the input data (not file names or dates),
+the gene and the parameters. An output whose key is unchanged and whose
+file still exists is skipped.
+'''
+import json
+import sqlite3
+import hashlib
+from pathlib import Path
+import pandas as pd
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+CACHE_NAME = 'analysis_cache.sqlite'
+# Bump when the outputs change for the same inputs.
+CACHE_VERSION = 1
+
+
+class AnalysisCache:
+    """Keys of the outputs written in an analysis folder.
+
+    :param cache_path: Path to the SQLite file.
+    :type cache_path: Path or str
+    """
+    def __init__(self, cache_path):
+        self.con = sqlite3.connect(cache_path)
+        self.con.execute('CREATE TABLE IF NOT EXISTS outputs '
+                         '(output TEXT PRIMARY KEY, key TEXT)')
+
+    def is_current(self, outputs, key):
+        """Return True if all outputs exist and were made with "key"."""
+        for output in outputs:
+            if not Path(output).exists():
+                return False
+            row = self.con.execute('SELECT key FROM outputs WHERE output = ?',
+                                   (str(output),)).fetchone()
+            if row is None or row[0] != key:
+                return False
+        return True
+
+    def record(self, outputs, key):
+        """Record the outputs as made with "key"."""
+        with self.con:
+            self.con.executemany('INSERT OR REPLACE INTO outputs '
+                                 'VALUES (?, ?)',
+                                 [(str(output), key) for output in outputs])
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def frame_hash(df):
+    """Return the sha256 of the index, columns and values of a DataFrame."""
+    sha256 = hashlib.sha256()
+    sha256.update(json.dumps([str(c) for c in df.columns]).encode())
+    sha256.update(pd.util.hash_pandas_object(df, index = True).
+                  to_numpy().tobytes())
+    return sha256.hexdigest()
+
+
+def input_key(*parts):
+    """Return the key of the inputs of an output.
+
+    :param parts: Hashes from "frame_hash" or "content_store.file_sha256",
+        gene names and parameters, anything "json" can dump.
+    :return: sha256 hex digest.
+    :rtype: str
+    """
+    text = json.dumps([CACHE_VERSION] + list(parts), default = str)
+    return hashlib.sha256(text.encode()).hexdigest()
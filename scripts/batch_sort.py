@@ -0,0 +1,109 @@
+'''
+Sort the downloads of many TCGA projects at once with a process pool.
+All projects share one metadata index, loaded from the metadata cache,
+and each project gets its own "output_folder/project_name/" tree.
+A semaphore limits how many projects run disk heavy steps at the same time.
+'''
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from file_sorter import sort_project
+from gdc_metadata import load_metadata_index
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+def main():
+    ### Input parameters. ###
+    output_folder = Path('C:/Repositories/Melanoma_TCGA/analysis/')
+    # files json and cases json exported for all projects.
+    json_files = Path('C:/Repositories/Melanoma_TCGA/data/files.2023-01-07.json')
+    json_cases = Path('C:/Repositories/Melanoma_TCGA/data/cases.2023-01-07.json')
+    data_folder = Path('C:/Repositories/Melanoma_TCGA/data/')
+    # One config per project, see "file_sorter.main" and "SORT_DEFAULTS".
+    projects = [
+        {'project_name': 'TCGA_SKCM',
+         'download_folder': data_folder / 'SKCM_download',
+         'manifest_file': 'gdc_manifest_SKCM.txt',
+         'main_data': data_folder / 'clinical_patient_skcm.txt'},
+        {'project_name': 'TCGA_UVM',
+         'download_folder': data_folder / 'UVM_download',
+         'manifest_file': 'gdc_manifest_UVM.txt',
+         'main_data': data_folder / 'clinical_patient_uvm.txt'},
+    ]
+    # Number of projects sorted at the same time.
+    max_workers = 4
+    # Number of projects in disk heavy steps at the same time.
+    max_disk_jobs = 2
+
+    shared = {'output_folder': output_folder,
+              'json_files': json_files,
+              'json_cases': json_cases,
+              'download_is_tar_gz': False}
+    configs = [{**shared, **project} for project in projects]
+    batch_sort(configs, max_workers = max_workers,
+               max_disk_jobs = max_disk_jobs)
+
+
+# Set in each worker process by "_init_worker".
+_metadata_index = None
+_disk_lock = None
+
+
+def _init_worker(json_files, json_cases, cache_path, disk_lock):
+    global _metadata_index, _disk_lock
+    _metadata_index = load_metadata_index(json_files, json_cases,
+                                          cache_path = cache_path)
+    _disk_lock = disk_lock
+
+
+def _sort_worker(config):
+    sort_project(config, metadata_index = _metadata_index,
+                 disk_lock = _disk_lock)
+    return config['project_name']
+
+
+def batch_sort(configs, max_workers = 4, max_disk_jobs = 2,
+               cache_path = None):
+    """Sort many projects with a process pool.
+
+    :param configs: Configs of "file_sorter.sort_project", all with the
+        same "json_files" and "json_cases".
+    :type configs: list
+    :param max_workers: Number of worker processes, defaults to 4
+    :type max_workers: int, optional
+    :param max_disk_jobs: Number of projects allowed in disk heavy
+        steps at the same time, defaults to 2
+    :type max_disk_jobs: int, optional
+    :param cache_path: Path to the metadata cache, defaults to None
+    :type cache_path: Path or str, optional
+    :return: Dictionary of project name -> error, None if succeeded.
+    :rtype: dict
+    """
+    json_files = configs[0]['json_files']
+    json_cases = configs[0]['json_cases']
+    # Build the metadata cache once, workers load it from disk.
+    load_metadata_index(json_files, json_cases, cache_path = cache_path,
+                        verbose = True)
+    disk_lock = multiprocessing.BoundedSemaphore(max_disk_jobs)
+    results = {}
+    with ProcessPoolExecutor(max_workers = max_workers,
+                             initializer = _init_worker,
+                             initargs = (json_files, json_cases,
+                                         cache_path, disk_lock)) as executor:
+        futures = {executor.submit(_sort_worker, config):
+                   config['project_name'] for config in configs}
+        for future in as_completed(futures):
+            project_name = futures[future]
+            try:
+                future.result()
+                results[project_name] = None
+                print(f'## Sorting completed for "{project_name}"')
+            except Exception as e:
+                results[project_name] = e
+                print(f'Error: Sorting failed for "{project_name}": {e}')
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+'''
+Typed loading of the clinical table and the expression frames.
+Stages are ordered Categoricals, the sub-stage merges (T1a -> T1,
+Stage_IIIB -> Stage_III) and the stage numbers for the survival models
+are defined here once, and applied as remaps of the category codes.
+Low cardinality text columns are Categoricals, days and expression
+values are float32.
+'''
+import numpy as np
+import pandas as pd
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+STRATIFIERS = ['tumor_stage', 'stage_T', 'stage_N', 'stage_M']
+# Column names in the clinical table -> short names.
+CLINICAL_RENAME = {'ajcc_tumor_pathologic_pt': 'stage_T',
+                   'ajcc_nodes_pathologic_pn': 'stage_N',
+                   'ajcc_metastasis_pathologic_pm': 'stage_M'}
+
+# Known stages from early to late, other labels are added after them.
+# "tumor_stage" uses the folder names of "file_sorter.py".
+STAGE_ORDER = {
+    'tumor_stage': ['Stage_0', 'Stage_I', 'Stage_IA', 'Stage_IB',
+                    'Stage_II', 'Stage_IIA', 'Stage_IIB', 'Stage_IIC',
+                    'Stage_III', 'Stage_IIIA', 'Stage_IIIB', 'Stage_IIIC',
+                    'Stage_IV'],
+    # All stages: '[Not Available]', 'T0', 'T1~4', 'Tis', 'TX'.
+    'stage_T': ['T0', 'Tis', 'T1', 'T1a', 'T1b', 'T2', 'T2a', 'T2b',
+                'T3', 'T3a', 'T3b', 'T4', 'T4a', 'T4b'],
+    # All stages: '[Not Available]', 'N0', 'N1~3', 'NX'.
+    'stage_N': ['N0', 'N1', 'N1a', 'N1b', 'N2', 'N2a', 'N2b', 'N2c', 'N3'],
+    # All stages: '[Not Available]', 'M0', 'M1'.
+    'stage_M': ['M0', 'M1', 'M1a', 'M1b', 'M1c'],
+}
+
+# Sub-stages merged into the main stage, for each stratifier.
+STAGE_MERGE = {
+    'tumor_stage': {'Stage_IA': 'Stage_I',
+                    'Stage_IB': 'Stage_I',
+                    'Stage_IIA': 'Stage_II',
+                    'Stage_IIB': 'Stage_II',
+                    'Stage_IIC': 'Stage_II',
+                    'Stage_IIIA': 'Stage_III',
+                    'Stage_IIIB': 'Stage_III',
+                    'Stage_IIIC': 'Stage_III'},
+    'stage_T': {'T1a': 'T1',
+                'T1b': 'T1',
+                'T2a': 'T2',
+                'T2b': 'T2',
+                'T3a': 'T3',
+                'T3b': 'T3',
+                'T4a': 'T4',
+                'T4b': 'T4'},
+    'stage_N': {'N1a': 'N1',
+                'N1b': 'N1',
+                'N2a': 'N2',
+                'N2b': 'N2',
+                'N2c': 'N2'},
+    'stage_M': {'M1a': 'M1',
+                'M1b': 'M1',
+                'M1c': 'M1'},
+}
+
+# Number of each merged stage for the survival models,
+# other labels ('[Not Available]', 'TX', 'Tis'...) are nan.
+STAGE_NUMBER = {
+    'tumor_stage': {'Stage_0': 0, 'Stage_I': 1, 'Stage_II': 2,
+                    'Stage_III': 3, 'Stage_IV': 4},
+    'stage_T': {'T0': 0, 'T1': 1, 'T2': 2, 'T3': 3, 'T4': 4},
+    'stage_N': {'N0': 0, 'N1': 1, 'N2': 2, 'N3': 3},
+    'stage_M': {'M0': 0, 'M1': 1},
+}
+
+
+def stage_categorical(values, stratifier):
+    """Return "values" as an ordered Categorical of the stratifier.
+
+    :param values: Stage labels.
+    :type values: Series
+    :param stratifier: One of "STRATIFIERS".
+    :type stratifier: str
+    :return: Known stages in "STAGE_ORDER" order, then other labels sorted.
+    :rtype: Series
+    """
+    values = pd.Series(values)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        labels = values.cat.categories
+    else:
+        labels = values.dropna().unique()
+    order = STAGE_ORDER[stratifier]
+    categories = order + sorted(set(labels) - set(order))
+    return values.astype(pd.CategoricalDtype(categories, ordered = True))
+
+
+def categorize_stages(df):
+    """Return a copy of "df" with the stratifier columns as stage Categoricals."""
+    df = df.copy()
+    for stratifier in STRATIFIERS:
+        if stratifier in df.columns:
+            df[stratifier] = stage_categorical(df[stratifier], stratifier)
+    return df
+
+
+def _remap(values, stratifier, mapping):
+    # Map the categories, then take the new value of each code.
+    values = stage_categorical(values, stratifier)
+    categories = values.cat.categories
+    new_labels = [mapping.get(c, c) for c in categories]
+    return values.cat.codes.to_numpy(), new_labels
+
+
+def merge_stages(df):
+    """Return a copy of "df" with sub-stages merged, see "STAGE_MERGE"."""
+    df = df.copy()
+    for stratifier, stage_merge in STAGE_MERGE.items():
+        if stratifier not in df.columns:
+            continue
+        codes, new_labels = _remap(df[stratifier], stratifier, stage_merge)
+        # Merged categories keep the order of their first sub-stage.
+        categories = list(dict.fromkeys(new_labels))
+        lookup = np.array([categories.index(label) for label in new_labels]
+                          + [-1])
+        df[stratifier] = pd.Categorical.from_codes(
+            lookup[codes], dtype = pd.CategoricalDtype(categories,
+                                                       ordered = True))
+    return df
+
+
+def stage_number(values, stratifier):
+    """Return the stage numbers of merged stages, see "STAGE_NUMBER".
+
+    :param values: Merged stage labels.
+    :type values: Series
+    :param stratifier: One of "STRATIFIERS".
+    :type stratifier: str
+    :return: float32 stage numbers, nan for other labels.
+    :rtype: Series
+    """
+    codes, new_labels = _remap(values, stratifier, {})
+    numbers = STAGE_NUMBER[stratifier]
+    lookup = np.array([numbers.get(label, np.nan) for label in new_labels]
+                      + [np.nan], dtype = np.float32)
+    return pd.Series(lookup[codes], index = pd.Series(values).index,
+                     name = stratifier)
+
+
+def read_clinical(main_data, columns, index_col = 'bcr_patient_barcode',
+                  max_categories = 50):
+    """Read the clinical table with compact dtypes.
+
+    :param main_data: Path to the clinical table,
+        e.g. "clinical_patient_skcm.txt".
+    :type main_data: Path or str
+    :param columns: Columns to read, with "index_col".
+    :type columns: list
+    :param index_col: Column of patient barcodes,
+        defaults to 'bcr_patient_barcode'
+    :type index_col: str, optional
+    :param max_categories: Text columns with at most this many values are
+        Categoricals, defaults to 50
+    :type max_categories: int, optional
+    :return: Stages renamed by "CLINICAL_RENAME" as stage Categoricals,
+        "*days_to*" columns as float32 with nan for "[Not Available]".
+    :rtype: DataFrame
+    """
+    df = pd.read_table(main_data, sep = '\t', header = 0,
+                       index_col = index_col, usecols = columns,
+                       skiprows = [1,2], dtype = str)
+    df = df.rename(columns = CLINICAL_RENAME)
+    for column in df.columns:
+        if column in STRATIFIERS:
+            df[column] = stage_categorical(df[column], column)
+        elif 'days_to' in column:
+            df[column] = pd.to_numeric(df[column], errors = 'coerce').\
+                            astype(np.float32)
+        elif df[column].nunique() <= max_categories:
+            df[column] = df[column].astype('category')
+    return df
+
+
+def survival_data(df_main):
+    """Days and event of each case, days to death for "Dead" and
+    days to last contact for "Alive". Cases without days are dropped.
+
+    :param df_main: Clinical table with "vital_status",
+        "last_contact_days_to" and "death_days_to", see "read_clinical".
+    :type df_main: DataFrame
+    :return: "vital_status" 1 for "Dead" and 0 for "Alive", and "days".
+    :rtype: DataFrame
+    """
+    alive = df_main['vital_status'] == 'Alive'
+    dead = df_main['vital_status'] == 'Dead'
+    days = df_main['last_contact_days_to'].where(alive,
+                                                 df_main['death_days_to'])
+    df = pd.DataFrame({'vital_status': dead.astype('int64'),
+                       'days': days})
+    return df[(alive | dead) & days.notna()]
+
+
+def compact_expression(df, value_columns):
+    """Return a copy of an expression frame with float32 values
+    and Categorical "case_id" and "tumor_stage"."""
+    df = df.copy()
+    df[value_columns] = df[value_columns].astype(np.float32)
+    if 'case_id' in df.columns:
+        df['case_id'] = df['case_id'].astype('category')
+    if 'tumor_stage' in df.columns:
+        df['tumor_stage'] = stage_categorical(df['tumor_stage'],
+                                              'tumor_stage')
+    return df
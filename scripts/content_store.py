@@ -0,0 +1,91 @@
+'''
+Content-addressed store of the sorted files.
+Each file is kept once under "content_store/<digest[:2]>/<digest>"
+and hardlinked into "<project>/<stage>/<barcode>/",
+so byte-identical re-uploads take no extra disk space.
+A file identical to one already in the same case folder is not linked,
+and is listed as a true duplicate instead.
+'''
+import os
+import shutil
+import hashlib
+from pathlib import Path
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+class ContentStore:
+    """Store of files by sha256 digest.
+
+    :param store_folder: Folder of the store, should be on the same
+        drive as the project folders for hardlinks.
+    :type store_folder: Path or str
+    """
+    def __init__(self, store_folder):
+        self.store_folder = Path(store_folder)
+        self.store_folder.mkdir(parents = True, exist_ok = True)
+        # (file name, case folder, identical file) of true duplicates.
+        self.duplicates = []
+
+    def object_path(self, digest):
+        return self.store_folder / digest[:2] / digest
+
+    def place(self, src, dst):
+        """Move "src" into the store and hardlink it as "dst".
+
+        :param src: The incoming file.
+        :type src: Path
+        :param dst: The file path in the case folder, may equal "src".
+        :type dst: Path
+        :return: "dst", or the identical file already in the case folder.
+        :rtype: Path
+        """
+        src, dst = Path(src), Path(dst)
+        digest = file_sha256(src)
+        obj = self.object_path(digest)
+        if obj.exists():
+            twin = self._linked_in(obj, dst.parent, exclude = src)
+            os.remove(src)
+            if twin is not None:
+                print(f'Attention: "{src.name}" is identical to "{twin}", '
+                      f'not linked')
+                self.duplicates.append((src.name, str(dst.parent),
+                                        str(twin)))
+                return twin
+        else:
+            obj.parent.mkdir(exist_ok = True)
+            shutil.move(src, obj)
+        link_or_copy(obj, dst)
+        return dst
+
+    @staticmethod
+    def _linked_in(obj, folder, exclude = None):
+        # File in "folder" that is a hardlink of "obj".
+        if not folder.is_dir():
+            return None
+        obj_stat = os.stat(obj)
+        for entry in os.scandir(folder):
+            if exclude is not None and entry.path == str(exclude):
+                continue
+            stat = entry.stat()
+            if (stat.st_ino, stat.st_dev) == (obj_stat.st_ino,
+                                              obj_stat.st_dev):
+                return Path(entry.path)
+        return None
+
+
+def link_or_copy(src, dst):
+    """Hardlink "src" to "dst", copy if hardlinks are not supported."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def file_sha256(file_path, chunk_size = 1 << 20):
+    """Return the sha256 hex digest of a file, read in chunks."""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
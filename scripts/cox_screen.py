@@ -0,0 +1,297 @@
+'''
+Genome wide Cox proportional hazard screen.
+For every gene in the expression store, fit a Cox model of the
+gene expression adjusted for "stage_M", with Efron ties as "lifelines".
+Genes are fitted in blocks with a batched Newton-Raphson on the risk
+sets shared by all genes, blocks run in a process pool.
+A few top genes are refitted with "lifelines.CoxPHFitter" as a check.
+
+Build the expression store first with "gene_search.py" (search_mode 'store').
+'''
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+from file_sorter import create_folder, replace_special_chars
+from expression_store import ExpressionStore, STORE_NAME
+from clinical import read_clinical, merge_stages, stage_number, survival_data
+from stage_scan import bh_fdr
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+def main():
+    ### Input parameters. ###
+    project_name = 'TCGA_SKCM'
+    output_folder = Path('C:/Repositories/Melanoma_TCGA/analysis/')
+    project_folder = output_folder / project_name
+    # Main data with all cases' information.
+    main_data = Path('C:/Repositories/Melanoma_TCGA/data/clinical_patient_skcm.txt')
+    # The columns we want.
+    columns_main = ['bcr_patient_barcode', 'vital_status',
+                    'last_contact_days_to', 'death_days_to',
+                    'ajcc_metastasis_pathologic_pm']
+    # Measure of the expression store to test.
+    measure = 'tpm_unstranded'
+    # Covariates adjusted for, besides the gene.
+    covariates = ['stage_M']
+    # Genes for each block, and worker processes.
+    block_size = 1000
+    workers = 4
+    # Number of top genes refitted with "lifelines" as a check.
+    check_genes = 3
+
+    store_folder = project_folder / STORE_NAME
+    if not (store_folder / 'sources.json').exists():
+        print(f'Error: No expression store in "{project_folder}", '
+              f'please run "gene_search.py" with search_mode "store".')
+        return
+    store = ExpressionStore(store_folder)
+    analysis_name = f'{replace_special_chars(project_name)}_analysis'
+    analysis_folder = create_folder(analysis_name, output_folder,
+                                    verbose = True)
+    survival_folder = create_folder('survival', analysis_folder,
+                                    verbose = True)
+
+    ### Survival data of the samples (columns) in the store. ###
+    df_main = merge_stages(read_clinical(main_data, columns_main))
+    df_surv = survival_data(df_main)
+    for covariate in covariates:
+        df_surv[covariate] = stage_number(df_main[covariate], covariate)
+    df_surv = store.samples[['case_id']].join(df_surv, on = 'case_id')
+    df_surv = df_surv.dropna()
+    print(f'Cases with survival data and {covariates}: {len(df_surv)}')
+
+    df_cox = cox_screen(store_folder, measure, df_surv.index.to_numpy(),
+                        df_surv['days'].to_numpy(),
+                        df_surv['vital_status'].to_numpy(),
+                        df_surv[covariates].to_numpy(),
+                        block_size = block_size, workers = workers)
+    for i, covariate in enumerate(covariates, 1):
+        df_cox = df_cox.rename(columns = {f'coef_{i}': f'coef_{covariate}',
+                                          f'p_{i}': f'p_{covariate}'})
+    df_cox = pd.concat([store.genes[['gene_id', 'gene_name']], df_cox],
+                       axis = 1)
+    df_cox = df_cox.sort_values('p', na_position = 'last')
+    cox_file = survival_folder / f'cox_screen_{measure}.txt'
+    print(f'Writing file: "{cox_file}"...')
+    df_cox.to_csv(cox_file, sep = '\t', index = False)
+    print(f'Genes with FDR < 0.05: {(df_cox["fdr"] < 0.05).sum()}')
+
+    ### Spot check with lifelines. ###
+    from lifelines import CoxPHFitter
+    matrix = store.matrix(measure)
+    for row in df_cox.dropna(subset = ['p']).index[:check_genes]:
+        df_check = df_surv[['days', 'vital_status'] + covariates].copy()
+        df_check['gene'] = matrix[row, df_surv.index.to_numpy()]
+        cph = CoxPHFitter().fit(df_check, duration_col = 'days',
+                                event_col = 'vital_status')
+        print(f'Check "{store.genes["gene_name"].iat[row]}": '
+              f'coef {df_cox.at[row, "coef"]:.6g} vs '
+              f'{cph.params_["gene"]:.6g}, p {df_cox.at[row, "p"]:.6g} vs '
+              f'{cph.summary.at["gene", "p"]:.6g}')
+
+
+# Set in each worker process by "_init_worker".
+_screen = None
+
+
+def _init_worker(store_folder, measure, columns, time, event, covariates):
+    global _screen
+    matrix = np.load(Path(store_folder) / f'{measure}.npy', mmap_mode = 'r')
+    _screen = (matrix, columns, CoxRiskSets(time, event), covariates)
+
+
+def _fit_block(start, end):
+    matrix, columns, risk_sets, covariates = _screen
+    genes = np.asarray(matrix[start:end][:, columns], dtype = np.float64)
+    return start, cox_fit_genes(genes, covariates, risk_sets)
+
+
+def cox_screen(store_folder, measure, columns, time, event, covariates,
+               block_size = 1000, workers = 4):
+    """Fit the Cox model of every gene of the store, in parallel blocks.
+
+    :param store_folder: Folder of the expression store.
+    :type store_folder: Path
+    :param measure: Measure of the store, e.g. 'tpm_unstranded'.
+    :type measure: str
+    :param columns: Columns (samples) of the store to use.
+    :type columns: ndarray
+    :param time: Days of each sample.
+    :type time: ndarray
+    :param event: 1 for death, 0 for censored.
+    :type event: ndarray
+    :param covariates: Samples x covariates to adjust for.
+    :type covariates: ndarray
+    :param block_size: Genes for each block, defaults to 1000
+    :type block_size: int, optional
+    :param workers: Number of worker processes, defaults to 4
+    :type workers: int, optional
+    :return: One row for each gene, see "cox_fit_genes", plus "fdr".
+    :rtype: DataFrame
+    """
+    n_genes = np.load(Path(store_folder) / f'{measure}.npy',
+                      mmap_mode = 'r').shape[0]
+    covariates = np.asarray(covariates, dtype = np.float64).reshape(
+                     len(time), -1)
+    blocks = [(start, min(start + block_size, n_genes))
+              for start in range(0, n_genes, block_size)]
+    results = []
+    with ProcessPoolExecutor(max_workers = workers,
+                             initializer = _init_worker,
+                             initargs = (store_folder, measure, columns,
+                                         time, event,
+                                         covariates)) as executor:
+        futures = [executor.submit(_fit_block, start, end)
+                   for start, end in blocks]
+        for future in futures:
+            start, df_block = future.result()
+            results.append(df_block)
+            print(f'Cox screen: {start + len(df_block)}/{n_genes} genes')
+    df_cox = pd.concat(results, ignore_index = True)
+    df_cox['fdr'] = bh_fdr(df_cox['p'].to_numpy())
+    return df_cox
+
+
+class CoxRiskSets:
+    """Risk sets and Efron tie slots shared by all genes.
+
+    :param time: Survival time of each sample.
+    :type time: ndarray
+    :param event: 1 for death, 0 for censored.
+    :type event: ndarray
+    """
+    def __init__(self, time, event):
+        time = np.asarray(time, dtype = np.float64)
+        event = np.asarray(event).astype(bool)
+        # Samples from the latest to the earliest time,
+        # so a risk set is a prefix and its sums are cumulative sums.
+        self.order = np.argsort(-time, kind = 'stable')
+        sorted_time = time[self.order]
+        event_times = np.unique(time[event])
+        # Last position of each risk set {time >= t} in "order".
+        self.risk_end = np.searchsorted(-sorted_time, -event_times,
+                                        side = 'right') - 1
+        # Deaths grouped by event time, for the tie sums.
+        deaths = np.flatnonzero(event)
+        deaths = deaths[np.argsort(time[deaths], kind = 'stable')]
+        self.deaths = deaths
+        counts = np.searchsorted(time[deaths], event_times, side = 'right') -\
+                 np.searchsorted(time[deaths], event_times, side = 'left')
+        self.death_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        # One Efron slot for each death: event time and l / d.
+        self.slot_time = np.repeat(np.arange(len(event_times)), counts)
+        self.slot_frac = np.concatenate([np.arange(d) / d for d in counts]) \
+                         if len(counts) else np.zeros(0)
+
+
+def _efron(beta, x, risk_sets):
+    # Log partial likelihood, gradient and Hessian of each gene.
+    # beta: (B, p), x: (B, n, p).
+    eta = np.einsum('bnp,bp->bn', x, beta)
+    shift = eta.max(axis = 1, keepdims = True)
+    w = np.exp(eta - shift)
+    wx = w[:, :, None] * x
+    wxx = wx[:, :, :, None] * x[:, :, None, :]
+    order, end = risk_sets.order, risk_sets.risk_end
+    s0 = np.cumsum(w[:, order], axis = 1)[:, end]
+    s1 = np.cumsum(wx[:, order], axis = 1)[:, end]
+    s2 = np.cumsum(wxx[:, order], axis = 1)[:, end]
+    deaths, starts = risk_sets.deaths, risk_sets.death_starts
+    d0 = np.add.reduceat(w[:, deaths], starts, axis = 1)
+    d1 = np.add.reduceat(wx[:, deaths], starts, axis = 1)
+    d2 = np.add.reduceat(wxx[:, deaths], starts, axis = 1)
+    j, frac = risk_sets.slot_time, risk_sets.slot_frac
+    phi = s0[:, j] - frac * d0[:, j]
+    phi1 = s1[:, j] - frac[:, None] * d1[:, j]
+    phi2 = s2[:, j] - frac[:, None, None] * d2[:, j]
+    loglik = eta[:, deaths].sum(axis = 1) - \
+             (np.log(phi) + shift).sum(axis = 1)
+    mean1 = phi1 / phi[:, :, None]
+    grad = x[:, deaths].sum(axis = 1) - mean1.sum(axis = 1)
+    hess = -(phi2 / phi[:, :, None, None] -
+             mean1[:, :, :, None] * mean1[:, :, None, :]).sum(axis = 1)
+    return loglik, grad, hess
+
+
+def cox_fit_genes(genes, covariates, risk_sets, max_iter = 50,
+                  tolerance = 1e-9):
+    """Fit "gene + covariates" Cox models of many genes at once.
+
+    :param genes: Genes x samples expression values.
+    :type genes: ndarray
+    :param covariates: Samples x covariates, shared by all genes.
+    :type covariates: ndarray
+    :param risk_sets: Risk sets of the samples.
+    :type risk_sets: CoxRiskSets
+    :param max_iter: Newton-Raphson iterations, defaults to 50
+    :type max_iter: int, optional
+    :param tolerance: Converged when the step is smaller, defaults to 1e-9
+    :type tolerance: float, optional
+    :return: For each gene "coef", "exp(coef)", "se(coef)", "z", "p" of the
+        gene, "coef_<i>" and "p_<i>" of each covariate, "log_likelihood"
+        and "converged"; nan for genes with constant values.
+    :rtype: DataFrame
+    """
+    n_genes, n = genes.shape
+    x = np.concatenate([genes[:, :, None],
+                        np.broadcast_to(covariates, (n_genes, n,
+                                                     covariates.shape[1]))],
+                       axis = 2)
+    # Standardize as "lifelines" does, for a stable Newton-Raphson.
+    mean = x.mean(axis = 1, keepdims = True)
+    scale = x.std(axis = 1, keepdims = True)
+    valid = (scale > 0).all(axis = (1, 2))
+    scale[scale == 0] = 1
+    x = (x - mean) / scale
+    n_params = x.shape[2]
+    beta = np.zeros((n_genes, n_params))
+    loglik, grad, hess = _efron(beta, x, risk_sets)
+    converged = np.zeros(n_genes, dtype = bool)
+    for _ in range(max_iter):
+        active = ~converged & valid
+        if not active.any():
+            break
+        idx = np.flatnonzero(active)
+        try:
+            step = np.linalg.solve(-hess[idx], grad[idx][:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = np.stack([np.linalg.lstsq(-h, g, rcond = None)[0]
+                             for h, g in zip(hess[idx], grad[idx])])
+        # Halve the step of genes whose likelihood would decrease.
+        step_size = np.ones(len(idx))
+        for _ in range(20):
+            new_beta = beta[idx] + step_size[:, None] * step
+            new_loglik, new_grad, new_hess = _efron(new_beta, x[idx],
+                                                    risk_sets)
+            worse = new_loglik < loglik[idx] - 1e-12
+            if not worse.any():
+                break
+            step_size[worse] /= 2
+        beta[idx], loglik[idx] = new_beta, new_loglik
+        grad[idx], hess[idx] = new_grad, new_hess
+        converged[idx] = np.abs(step_size[:, None] * step).max(axis = 1) < \
+                         tolerance
+    with np.errstate(invalid = 'ignore'):
+        variance = np.linalg.pinv(-hess)
+        se = np.sqrt(np.diagonal(variance, axis1 = 1, axis2 = 2))
+    # Back to the original scale of each covariate.
+    beta = beta / scale[:, 0, :]
+    se = se / scale[:, 0, :]
+    beta[~valid], se[~valid] = np.nan, np.nan
+    z = beta / se
+    p = 2 * norm.sf(np.abs(z))
+    result = {'coef': beta[:, 0], 'exp(coef)': np.exp(beta[:, 0]),
+              'se(coef)': se[:, 0], 'z': z[:, 0], 'p': p[:, 0]}
+    for i in range(1, n_params):
+        result[f'coef_{i}'] = beta[:, i]
+        result[f'p_{i}'] = p[:, i]
+    result['log_likelihood'] = np.where(valid, loglik, np.nan)
+    result['converged'] = converged
+    return pd.DataFrame(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+'''
+Optimal expression cutoff of a gene for survival.
+Every cutoff between the 10th and 90th percentiles splits the cases into
+high (>= cutoff) and low groups, the log-rank statistic of all the splits
+is computed at once with cumulative sums over the cases sorted by
+expression, on the event times sorted once.
+The maximally selected statistic gets two p-values:
+    p_permutation: from survival data permuted across the cases,
+        seeded and run in a process pool, so results are reproducible.
+    p_lausen: the Lausen & Schumacher (1992) approximation.
+'''
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+from file_sorter import create_folder
+from clinical import read_clinical, survival_data
+from content_store import file_sha256
+from analysis_cache import AnalysisCache, CACHE_NAME, input_key
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+def main():
+    ### Input parameters. ###
+    project_name = 'TCGA_SKCM'
+    output_folder = Path('C:/Repositories/Melanoma_TCGA/analysis/')
+    project_folder = output_folder / project_name
+    target_gene = 'BRD3OS'
+    gene_folder = output_folder / 'TCGA_SKCM_analysis' / target_gene
+    # Main data with all cases' information.
+    main_data = Path('C:/Repositories/Melanoma_TCGA/data/clinical_patient_skcm.txt')
+    # The columns we want.
+    columns_main = ['bcr_patient_barcode', 'vital_status',
+                    'last_contact_days_to', 'death_days_to']
+    gene_file = gene_folder / f'merge_{target_gene}.txt'
+    measure = 'tpm_unstranded'
+    # Cutoffs between these quantiles of the expression.
+    min_quantile = 0.1
+    max_quantile = 0.9
+    # Permutations of the survival data, the seed makes them reproducible.
+    permutations = 10000
+    seed = 0
+    workers = 4
+
+    survival_folder = create_folder('survival', gene_folder,
+                                    verbose = True)
+    scan_file = survival_folder / f'cutoff_scan_{measure}.txt'
+    summary_file = survival_folder / f'cutoff_scan_summary_{measure}.txt'
+    cache = AnalysisCache(gene_folder.parent / CACHE_NAME)
+    key = input_key('cutoff_scan', target_gene, measure,
+                    file_sha256(gene_file), file_sha256(main_data),
+                    columns_main, min_quantile, max_quantile,
+                    permutations, seed)
+    if cache.is_current([scan_file, summary_file], key):
+        print(f'Up to date: "{scan_file}"')
+        cache.close()
+        return
+
+    df_surv = survival_data(read_clinical(main_data, columns_main))
+    df_gene = pd.read_csv(gene_file, sep = '\t', header = 0, index_col = 0)
+    df = pd.concat([df_surv, df_gene[measure]], axis = 1,
+                   join = 'inner').dropna()
+    print(f'Cases with survival data: {len(df)}')
+
+    scan = CutoffScan(df[measure].to_numpy(), df['days'].to_numpy(),
+                      df['vital_status'].to_numpy(),
+                      min_quantile = min_quantile,
+                      max_quantile = max_quantile)
+    df_scan = scan.table()
+    best = df_scan['abs_statistic'].idxmax()
+    p_permutation = scan.permutation_p(permutations, seed = seed,
+                                       workers = workers)
+    df_summary = pd.DataFrame([{
+        'gene': target_gene, 'measure': measure,
+        'cutoff': df_scan.at[best, 'cutoff'],
+        'n_high': df_scan.at[best, 'n_high'],
+        'n_low': df_scan.at[best, 'n_low'],
+        'statistic': df_scan.at[best, 'statistic'],
+        'p_permutation': p_permutation,
+        'p_lausen': scan.lausen_p(),
+        'cutoffs': len(df_scan), 'permutations': permutations,
+        'seed': seed}])
+    print(df_summary.T.to_string(header = False))
+
+    print(f'Writing file: "{scan_file}"...')
+    df_scan.to_csv(scan_file, sep = '\t', index = False)
+    print(f'Writing file: "{summary_file}"...')
+    df_summary.to_csv(summary_file, sep = '\t', index = False)
+    cache.record([scan_file, summary_file], key)
+    cache.close()
+
+
+def logrank_splits(time_index, event, n_times, splits):
+    """Log-rank statistics of splits of the cases into a first (high)
+    group and the rest, for one or more orders of the cases.
+
+    :param time_index: Index of the last event time <= the case time,
+        -1 before the first event time, for (..., cases) orders.
+    :type time_index: ndarray
+    :param event: True for death, same shape as "time_index".
+    :type event: ndarray
+    :param n_times: Number of event times.
+    :type n_times: int
+    :param splits: Number of cases in the first group of each split.
+    :type splits: ndarray
+    :return: Standardized log-rank statistic (observed - expected deaths
+        of the first group over the standard deviation), (..., splits).
+    :rtype: ndarray
+    """
+    times = np.arange(n_times)
+    at_risk = (times <= time_index[..., None]).astype(np.float64)
+    deaths = ((times == time_index[..., None]) &
+              event[..., None]).astype(np.float64)
+    # Cases at risk and deaths of the first group at each event time.
+    n_high = np.cumsum(at_risk, axis = -2)
+    d_high = np.cumsum(deaths, axis = -2)
+    n_all, d_all = n_high[..., -1:, :], d_high[..., -1:, :]
+    n_high = n_high[..., splits - 1, :]
+    d_high = d_high[..., splits - 1, :]
+    share = n_high / n_all
+    expected = (d_all * share).sum(axis = -1)
+    variance = (d_all * share * (1 - share) * (n_all - d_all) /
+                np.maximum(n_all - 1, 1)).sum(axis = -1)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return (d_high.sum(axis = -1) - expected) / np.sqrt(variance)
+
+
+# Set in each worker process by "_init_worker".
+_scan = None
+
+
+def _init_worker(time_index, event, n_times, splits):
+    global _scan
+    _scan = (time_index, event, n_times, splits)
+
+
+def _permutation_max(seed_sequence, n_permutations):
+    time_index, event, n_times, splits = _scan
+    rng = np.random.default_rng(seed_sequence)
+    orders = rng.permuted(np.tile(np.arange(len(event)),
+                                  (n_permutations, 1)), axis = 1)
+    statistic = logrank_splits(time_index[orders], event[orders],
+                               n_times, splits)
+    return np.nanmax(np.abs(statistic), axis = 1)
+
+
+class CutoffScan:
+    """Log-rank statistics of the cutoffs of one gene.
+
+    :param values: Expression of each case.
+    :type values: ndarray
+    :param time: Days of each case.
+    :type time: ndarray
+    :param event: 1 for death, 0 for censored.
+    :type event: ndarray
+    :param min_quantile: Lowest cutoff quantile, defaults to 0.1
+    :type min_quantile: float, optional
+    :param max_quantile: Highest cutoff quantile, defaults to 0.9
+    :type max_quantile: float, optional
+    """
+    def __init__(self, values, time, event, min_quantile = 0.1,
+                 max_quantile = 0.9):
+        values = np.asarray(values, dtype = np.float64)
+        time = np.asarray(time, dtype = np.float64)
+        event = np.asarray(event).astype(bool)
+        # Cases from the highest to the lowest expression,
+        # the high group of a cutoff is a prefix.
+        order = np.argsort(-values, kind = 'stable')
+        self.values = values[order]
+        event_times = np.unique(time[event])
+        self.n_times = len(event_times)
+        self.time_index = np.searchsorted(event_times, time[order],
+                                          side = 'right') - 1
+        self.event = event[order]
+        low, high = np.quantile(values, [min_quantile, max_quantile])
+        self.cutoffs = np.unique(self.values[(self.values >= low) &
+                                             (self.values <= high)])[::-1]
+        # Cases >= each cutoff, the lowest cutoff may not leave a low group.
+        self.splits = np.searchsorted(-self.values, -self.cutoffs,
+                                      side = 'right')
+        keep = self.splits < len(self.values)
+        self.cutoffs, self.splits = self.cutoffs[keep], self.splits[keep]
+        self.statistic = logrank_splits(self.time_index, self.event,
+                                        self.n_times, self.splits)
+
+    def table(self):
+        """Return cutoff, n_high, n_low, statistic and abs_statistic
+        of each cutoff."""
+        return pd.DataFrame({'cutoff': self.cutoffs,
+                             'n_high': self.splits,
+                             'n_low': len(self.values) - self.splits,
+                             'statistic': self.statistic,
+                             'abs_statistic': np.abs(self.statistic)})
+
+    def max_statistic(self):
+        return np.nanmax(np.abs(self.statistic))
+
+    def lausen_p(self):
+        """P-value of the maximally selected statistic, approximation of
+        Lausen & Schumacher (1992) with the observed split proportions."""
+        b = self.max_statistic()
+        low_share = 1 - self.splits / len(self.values)
+        eps1, eps2 = low_share.min(), low_share.max()
+        density = norm.pdf(b)
+        p = 4 * density / b + density * (b - 1 / b) * \
+            np.log(eps2 * (1 - eps1) / ((1 - eps2) * eps1))
+        return float(np.clip(p, 0, 1))
+
+    def permutation_p(self, permutations = 10000, seed = 0, workers = 4,
+                      chunk_size = 100):
+        """P-value of the maximally selected statistic from permutations.
+
+        :param permutations: Number of permutations, defaults to 10000
+        :type permutations: int, optional
+        :param seed: Seed of the random permutations, defaults to 0
+        :type seed: int, optional
+        :param workers: Number of worker processes, defaults to 4
+        :type workers: int, optional
+        :param chunk_size: Permutations in each task, defaults to 100
+        :type chunk_size: int, optional
+        :return: (1 + permutations with a statistic >= observed)
+            / (1 + permutations).
+        :rtype: float
+        """
+        sizes = [min(chunk_size, permutations - start)
+                 for start in range(0, permutations, chunk_size)]
+        # One child seed per chunk, the same for any number of workers.
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        with ProcessPoolExecutor(max_workers = workers,
+                                 initializer = _init_worker,
+                                 initargs = (self.time_index, self.event,
+                                             self.n_times,
+                                             self.splits)) as executor:
+            maxima = np.concatenate(list(executor.map(_permutation_max,
+                                                      seeds, sizes)))
+        # Tolerance for the same split found in another order.
+        exceed = (maxima >= self.max_statistic() - 1e-10).sum()
+        return float((1 + exceed) / (1 + permutations))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+'''
+Gene x sample matrices of the STAR gene count files of a project.
+All count files are parsed once into float32 ".npy" files,
+one for each measure, stored gene major so the values of one gene
+across all samples are a contiguous slice of a memory map.
+
+"<project>/expression_store/":
+    genes.tsv: gene_id, gene_name, gene_type of each row.
+    samples.tsv: path, case_id, tumor_stage of each column.
+    <measure>.npy: float32 matrix of genes x samples.
+    sources.json: size and mtime of the count files, to detect changes.
+When the count files change, the columns of unchanged files are copied
+from the previous store, only new or changed files are parsed.
+'''
+import os
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+STORE_NAME = 'expression_store'
+# Bump when the store layout changes.
+STORE_VERSION = 1
+GENE_COLUMNS = ['gene_id', 'gene_name', 'gene_type']
+MEASURES = ['unstranded', 'tpm_unstranded', 'fpkm_unstranded',
+            'fpkm_uq_unstranded']
+
+
+class ExpressionStore:
+    """Read only view of an expression store.
+
+    :param store_folder: Folder of the store.
+    :type store_folder: Path or str
+    """
+    def __init__(self, store_folder):
+        self.store_folder = Path(store_folder)
+        self.genes = pd.read_table(self.store_folder / 'genes.tsv',
+                                   dtype = str, keep_default_na = False)
+        self.samples = pd.read_table(self.store_folder / 'samples.tsv',
+                                     dtype = str, keep_default_na = False)
+        self._matrices = {}
+        # gene_name or gene_id -> row numbers.
+        self._rows = {}
+        for column in ['gene_id', 'gene_name']:
+            for row, key in enumerate(self.genes[column]):
+                self._rows.setdefault(key, []).append(row)
+
+    def matrix(self, measure):
+        """Return the genes x samples memory map of a measure."""
+        if measure not in self._matrices:
+            self._matrices[measure] = np.load(self.store_folder /
+                                              f'{measure}.npy',
+                                              mmap_mode = 'r')
+        return self._matrices[measure]
+
+    def gene_rows(self, gene):
+        """Return the row numbers of a gene_name or gene_id."""
+        return self._rows.get(gene, [])
+
+    def gene_frame(self, gene, measures = MEASURES[1:]):
+        """Values of one or more genes in all samples, in the layout of
+        "gene_search.gene_search": index gene_name, one column for
+        each measure, plus "case_id" and "tumor_stage".
+
+        :param gene: The gene_name or gene_id, or a list of them.
+        :type gene: str or list
+        :param measures: Measures to return, defaults to tpm, fpkm, fpkm_uq
+        :type measures: list, optional
+        :return: One row for each sample, for each gene_id of the names.
+        :rtype: DataFrame
+        """
+        genes = [gene] if isinstance(gene, str) else gene
+        rows = [row for g in genes for row in self.gene_rows(g)]
+        if not rows:
+            return pd.DataFrame(columns = list(measures) +
+                                ['case_id', 'tumor_stage'])
+        n_samples = len(self.samples)
+        # One fancy index for each measure, rows gene by gene.
+        df = pd.DataFrame({measure: self.matrix(measure)[rows].ravel()
+                           for measure in measures},
+                          index = np.repeat(self.genes['gene_name'].
+                                            to_numpy()[rows], n_samples))
+        df['case_id'] = np.tile(self.samples['case_id'].to_numpy(), len(rows))
+        df['tumor_stage'] = np.tile(self.samples['tumor_stage'].to_numpy(),
+                                    len(rows))
+        return df
+
+
+def read_counts(file_path):
+    """Read the gene rows of a STAR gene count file.
+
+    :param file_path: Path to the file.
+    :type file_path: Path or str
+    :return: Gene columns and measures, "N_" rows removed.
+    :rtype: DataFrame
+    """
+    df = pd.read_table(file_path, usecols = GENE_COLUMNS + MEASURES,
+                       skiprows = 1)
+    return df[~df['gene_id'].str.startswith('N_')].reset_index(drop = True)
+
+
+def _source_stats(files_list):
+    sources = {}
+    for file in files_list:
+        stat = os.stat(file)
+        sources[str(file)] = [stat.st_size, stat.st_mtime_ns]
+    return {'version': STORE_VERSION, 'files': sources}
+
+
+def _reusable_columns(files_list, store_folder):
+    # File path -> column in the previous store, for unchanged files.
+    sources_file = store_folder / 'sources.json'
+    if not sources_file.exists():
+        return {}
+    with open(sources_file) as f:
+        previous = json.load(f)
+    if previous.get('version') != STORE_VERSION:
+        return {}
+    samples = pd.read_table(store_folder / 'samples.tsv', dtype = str,
+                            keep_default_na = False)
+    columns = {path: i for i, path in enumerate(samples['path'])}
+    current = _source_stats(files_list)['files']
+    return {path: columns[path] for path, stats in current.items()
+            if path in columns and previous['files'].get(path) == stats}
+
+
+def build_expression_store(files_list, store_folder, workers = 4,
+                           block_size = 64):
+    """Parse the count files into the gene x sample matrices, the columns
+    of files unchanged since the previous store are copied from it.
+
+    :param files_list: List of STAR gene count file paths
+        in "<project>/<stage>/<barcode>/", one for each case.
+    :type files_list: list
+    :param store_folder: Folder of the store.
+    :type store_folder: Path
+    :param workers: Number of threads reading files, defaults to 4
+    :type workers: int, optional
+    :param block_size: Samples written to the matrices at a time,
+        defaults to 64
+    :type block_size: int, optional
+    :raises ValueError: If "files_list" is empty.
+    """
+    if not files_list:
+        raise ValueError(f'No count files to build the expression store '
+                         f'"{store_folder}", please check the project path')
+    files_list = [str(f) for f in files_list]
+    store_folder.mkdir(parents = True, exist_ok = True)
+    # Columns of the previous store for files with the same size and mtime.
+    reuse = _reusable_columns(files_list, store_folder)
+    (store_folder / 'sources.json').unlink(missing_ok = True)
+    if reuse:
+        genes = pd.read_table(store_folder / 'genes.tsv', dtype = str,
+                              keep_default_na = False)
+        previous = {m: np.load(store_folder / f'{m}.npy', mmap_mode = 'r')
+                    for m in MEASURES}
+    else:
+        genes = read_counts(files_list[0])[GENE_COLUMNS]
+        previous = {}
+    n_genes, n_samples = len(genes), len(files_list)
+    print(f'Expression store: {len(reuse)} unchanged files reused, '
+          f'{n_samples - len(reuse)} files to parse')
+    # Write to ".part" files, replace the store only when complete.
+    part_files = {m: store_folder / f'{m}.npy.part' for m in MEASURES}
+    matrices = {m: np.lib.format.open_memmap(part_files[m], mode = 'w+',
+                                             dtype = np.float32,
+                                             shape = (n_genes, n_samples))
+                for m in MEASURES}
+    gene_ids = genes['gene_id']
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        for start in range(0, n_samples, block_size):
+            block_files = files_list[start:start + block_size]
+            block = {m: np.empty((n_genes, len(block_files)),
+                                 dtype = np.float32) for m in MEASURES}
+            reused = [i for i, f in enumerate(block_files) if f in reuse]
+            if reused:
+                columns = [reuse[block_files[i]] for i in reused]
+                for m in MEASURES:
+                    block[m][:, reused] = previous[m][:, columns]
+            parse = [i for i, f in enumerate(block_files) if f not in reuse]
+            parsed = executor.map(read_counts,
+                                  [block_files[i] for i in parse])
+            for i, df in zip(parse, parsed):
+                if not df['gene_id'].equals(gene_ids):
+                    print(f'Attention: Genes of "{block_files[i]}" differ '
+                          f'from the store, reordering')
+                    df = df.set_index('gene_id').reindex(gene_ids)
+                for m in MEASURES:
+                    block[m][:, i] = df[m].to_numpy(dtype = np.float32)
+            for m in MEASURES:
+                matrices[m][:, start:start + len(block_files)] = block[m]
+            print(f'Expression store: {start + len(block_files)}'
+                  f'/{n_samples} files')
+    # Close the previous matrices before replacing their files.
+    previous.clear()
+    for m in MEASURES:
+        matrices[m].flush()
+        del matrices[m]
+        os.replace(part_files[m], store_folder / f'{m}.npy')
+    genes.to_csv(store_folder / 'genes.tsv', sep = '\t', index = False)
+    samples = pd.DataFrame({'path': files_list,
+                            'case_id': [Path(f).parent.name
+                                        for f in files_list],
+                            'tumor_stage': [Path(f).parents[1].name
+                                            for f in files_list]})
+    samples.to_csv(store_folder / 'samples.tsv', sep = '\t', index = False)
+    # Written last, marks the store as complete.
+    with open(store_folder / 'sources.json', 'w') as f:
+        json.dump(_source_stats(files_list), f)
+
+
+def load_expression_store(project_folder, files_list, workers = 4):
+    """Open the expression store of a project,
+    update it first if the count files changed.
+
+    :param project_folder: The project folder.
+    :type project_folder: Path
+    :param files_list: List of STAR gene count file paths, one for each case.
+    :type files_list: list
+    :param workers: Number of threads reading files, defaults to 4
+    :type workers: int, optional
+    :return: The expression store.
+    :rtype: ExpressionStore
+    """
+    store_folder = project_folder / STORE_NAME
+    sources_file = store_folder / 'sources.json'
+    current = None
+    if sources_file.exists():
+        with open(sources_file) as f:
+            current = json.load(f)
+    if current != _source_stats(sorted(str(f) for f in files_list)):
+        print(f'## Updating expression store "{store_folder}"...')
+        build_expression_store(sorted(files_list), store_folder,
+                               workers = workers)
+    else:
+        print(f'## Loading expression store "{store_folder}"...')
+    return ExpressionStore(store_folder)
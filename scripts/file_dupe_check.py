@@ -1,12 +1,22 @@
 '''
 To check the "duplicate" files.
-Copy the "duplicate" files into folder "dupe_files_check".
+Report mode: fingerprint the data columns of each "duplicate" pair
+and write one table saying whether the files are identical,
+differ in metadata only, or differ in data.
+Otherwise copy the "duplicate" files into folder "dupe_files_check".
 '''
 import os
+import re
 import shutil
+import fnmatch
+import hashlib
 from pathlib import Path
 from glob import glob
-from file_sorter import create_folder, read_json, search_target_files
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from file_sorter import create_folder, search_target_files, open_maybe_gz
+from gdc_metadata import load_metadata_index
+from md5_check import file_md5
 
 __author__ = "Johnathan Lin <jagonball@gmail.com>"
 __email__ = "jagonball@gmail.com"
@@ -21,21 +31,19 @@ def main():
     json_cases = Path('C:/Repositories/Melanoma_TCGA/data/cases.2023-01-07.json')
     # Files to rename at first '.'.
     files_re_list_1 = ['*.wxs.aliquot_ensemble_masked.maf',
+                       '*.wxs.aliquot_ensemble_masked.maf.gz',
                        '*.rna_seq.augmented_star_gene_counts.tsv',
                        '*.mirbase21.isoforms.quantification.txt',
                        '*.mirbase21.mirnas.quantification.txt']
     # Files to rename at second '.'.
     files_re_list_2 = ['*.gene_level_copy_number.v36.tsv']
+    # Write a fingerprint report instead of copying files.
+    report_mode = True
+    workers = 4
 
-    check_folder = create_folder('dupe_files_check', download_folder,
-                                 verbose = True)
-
-    # Read json files.
-    parsed_json_files = read_json(json_files)
-    #print(f'Number of files in files.json: {len(parsed_json_files)}')
-    #print(parsed_json_files[0:2])
-    parsed_json_cases = read_json(json_cases)
-    #print(f'Number of cases cases.json: {len(parsed_json_cases)}')
+    # Load json files through the metadata cache.
+    metadata_index = load_metadata_index(json_files, json_cases,
+                                         verbose = True)
 
     # Check temp_folder for remaining files.
     files_list = os.listdir(temp_folder)
@@ -49,23 +57,40 @@ def main():
           f'{len(target_files_list_2)}')
 
 
+    if report_mode:
+        project_folder = output_folder / project_name
+        case_index = index_case_files(project_folder)
+        # Remaining files against their counterpart in the project.
+        pairs = find_dupe_pairs(target_files_list_1, metadata_index,
+                                case_index, delimiter = '.', name_pos = 1)
+        pairs += find_dupe_pairs(target_files_list_2, metadata_index,
+                                 case_index, delimiter = '.', name_pos = 2)
+        # "_2", "_3" files against the first file in the case folder.
+        pairs += find_sibling_pairs(case_index)
+        report = dupe_report(pairs, workers = workers)
+        report_file = download_folder / 'dupe_report.tsv'
+        report.to_csv(report_file, sep = '\t', index = False)
+        print(f'Writing file: "{report_file}"...')
+        print(report['status'].value_counts().to_string())
+        return
+
+    check_folder = create_folder('dupe_files_check', download_folder,
+                                 verbose = True)
     copy_check_files(target_files_list_1,
-                     files_json = parsed_json_files,
-                     cases_json = parsed_json_cases,
+                     metadata_index = metadata_index,
                      output_folder = output_folder,
                      project_name = project_name,
                      check_folder = check_folder,
                      delimiter = '.', name_pos = 1)
     copy_check_files(target_files_list_2,
-                     files_json = parsed_json_files,
-                     cases_json = parsed_json_cases,
+                     metadata_index = metadata_index,
                      output_folder = output_folder,
                      project_name = project_name,
                      check_folder = check_folder,
                      delimiter = '.', name_pos = 2)
 
     
-def copy_check_files(files_list, files_json, cases_json,
+def copy_check_files(files_list, metadata_index,
                      output_folder, project_name, check_folder,
                      delimiter = '.', name_pos = 1):
     # Iterate files_list, find "duplicate" file in output_folder.
@@ -76,21 +101,19 @@ def copy_check_files(files_list, files_json, cases_json,
         # Add ".gz" for the ".maf" files.
         if target_file_name.endswith('.maf'):
             target_file_name = target_file_name + '.gz'
-        # Iterate files_json for matching file_name.
-        target_case_id = next((dict['cases'][0]['case_id']\
-                               for dict in files_json\
-                               if dict['file_name'] == target_file_name),
-                              None)
-        target_submitter_id = next((dict['submitter_id']\
-                                    for dict in cases_json\
-                                    if dict['case_id'] == target_case_id),
-                                   None)
+        # Look up submitter_id with the metadata index.
+        target_submitter_id = metadata_index.submitter_id(target_file_name)
+        if target_submitter_id is None:
+            print(f'Error: Match not found for file "{file}"')
+            continue
+        # Match the counterpart whether it is kept compressed or not.
+        name_match = name_keep.removesuffix('.gz')
         target_folder = str(output_folder / project_name / '*' \
                             / target_submitter_id / '*')
         # List of files in "target_submitter_id" folder.
         case_files = glob(target_folder)
         # Copy the "duplicate" file to "check_folder".
-        file_to_check = [p for p in case_files if f'{target_submitter_id}.{name_keep}' in p]
+        file_to_check = [p for p in case_files if f'{target_submitter_id}.{name_match}' in p]
         print(file_to_check)
         file_to_check_name = Path(file_to_check[0]).name
         #print(file_to_check)
@@ -100,5 +123,159 @@ def copy_check_files(files_list, files_json, cases_json,
         shutil.copyfile(file, new_name)
 
 
+# Columns fingerprinted for each file type, key columns first.
+FINGERPRINT_COLUMNS = {
+    '*.rna_seq.augmented_star_gene_counts*.tsv': ['gene_id', 'unstranded'],
+    '*.wxs.aliquot_ensemble_masked*.maf*': ['Chromosome', 'Start_Position',
+                                            'End_Position',
+                                            'Reference_Allele',
+                                            'Tumor_Seq_Allele2'],
+    '*.mirbase21.mirnas.quantification*.txt': ['miRNA_ID', 'read_count'],
+    '*.mirbase21.isoforms.quantification*.txt': ['miRNA_ID',
+                                                 'isoform_coords',
+                                                 'read_count'],
+    '*.gene_level_copy_number*.tsv': ['gene_id', 'copy_number'],
+}
+# "_2", "_3"... added by "file_sorter.unique_file_path", before the last
+# extension, or at the end once ".gz" is removed, e.g. "a.wxs.maf_2".
+DUPE_SUFFIX = re.compile(r'(_\d+)+(?=\.[^.]+$|$)')
+
+
+def index_case_files(project_folder):
+    """List the files of each case folder in "project/stage/barcode/".
+
+    :param project_folder: The project folder.
+    :type project_folder: Path
+    :return: Dictionary of barcode -> list of file paths.
+    :rtype: dict
+    """
+    case_index = {}
+    for file_path in project_folder.glob('*/*/*'):
+        if file_path.is_file():
+            case_index.setdefault(file_path.parent.name, []).append(file_path)
+    return case_index
+
+
+def find_dupe_pairs(files_list, metadata_index, case_index,
+                    delimiter = '.', name_pos = 1):
+    """Pair each file with its counterpart already in the project.
+
+    :param files_list: A list of file paths with original names.
+    :type files_list: list
+    :param metadata_index: Index of files json and cases json.
+    :type metadata_index: MetadataIndex
+    :param case_index: Output of "index_case_files".
+    :type case_index: dict
+    :param delimiter: Delimiter of file name, defaults to '.'
+    :type delimiter: str, optional
+    :param name_pos: Position of "Name to keep" of the specified delimiter, defaults to 1
+    :type name_pos: int, optional
+    :return: List of (file, counterpart) paths.
+    :rtype: list
+    """
+    pairs = []
+    for file in files_list:
+        target_file_name = Path(file).name
+        name_keep = delimiter.join(target_file_name.split(delimiter)[name_pos:])
+        # Add ".gz" for the ".maf" files.
+        if target_file_name.endswith('.maf'):
+            target_file_name = target_file_name + '.gz'
+        target_submitter_id = metadata_index.submitter_id(target_file_name)
+        if target_submitter_id is None:
+            print(f'Error: Match not found for file "{file}"')
+            continue
+        name_match = f'{target_submitter_id}.{name_keep.removesuffix(".gz")}'
+        counterparts = [p for p in case_index.get(target_submitter_id, [])
+                        if p.name.startswith(name_match)]
+        if not counterparts:
+            print(f'Attention: No counterpart found for file "{file}"')
+            continue
+        pairs.append((Path(file), counterparts[0]))
+    return pairs
+
+
+def find_sibling_pairs(case_index):
+    """Pair "name_2.ext", "name_3.ext"... in a case folder with "name.ext",
+    and decompressed "name.ext_2" with "name.ext".
+
+    :param case_index: Output of "index_case_files".
+    :type case_index: dict
+    :return: List of (file, counterpart) paths.
+    :rtype: list
+    """
+    pairs = []
+    for files in case_index.values():
+        names = {p.name: p for p in files}
+        for p in files:
+            base = DUPE_SUFFIX.sub('', p.name)
+            if base != p.name and base in names:
+                pairs.append((p, names[base]))
+    return pairs
+
+
+def data_fingerprint(file_path):
+    """Checksum of the data columns of a file, rows sorted by the columns,
+    None for file types without data columns.
+
+    :param file_path: Path to the file.
+    :type file_path: Path
+    :return: md5 hex digest of the data columns, or None.
+    :rtype: str or None
+    """
+    columns = next((c for pattern, c in FINGERPRINT_COLUMNS.items()
+                    if fnmatch.fnmatchcase(file_path.name, pattern)), None)
+    if columns is None:
+        return None
+    # Skip the comment lines, e.g. "# gene-model" and "#version".
+    comment_lines = 0
+    with open_maybe_gz(file_path) as file:
+        for line in file:
+            if not line.startswith('#'):
+                break
+            comment_lines += 1
+    df = pd.read_table(file_path, usecols = columns, dtype = str,
+                       skiprows = comment_lines, keep_default_na = False)
+    df = df[columns].sort_values(columns, ignore_index = True)
+    row_hashes = pd.util.hash_pandas_object(df, index = False)
+    return hashlib.md5(row_hashes.to_numpy().tobytes()).hexdigest()
+
+
+def fingerprint_file(file_path):
+    """Return (md5 of the whole file, data fingerprint) of a file."""
+    return file_md5(file_path), data_fingerprint(Path(file_path))
+
+
+def dupe_report(pairs, workers = 4):
+    """Fingerprint the files of each pair in parallel and compare them.
+
+    :param pairs: List of (file, counterpart) paths.
+    :type pairs: list
+    :param workers: Number of worker processes, defaults to 4
+    :type workers: int, optional
+    :return: One row per pair with status "identical",
+        "metadata_differs" or "data_differs".
+    :rtype: DataFrame
+    """
+    files = sorted({p for pair in pairs for p in pair})
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        fingerprints = dict(zip(files, executor.map(fingerprint_file, files)))
+    rows = []
+    for file_1, file_2 in pairs:
+        md5_1, data_1 = fingerprints[file_1]
+        md5_2, data_2 = fingerprints[file_2]
+        if md5_1 == md5_2:
+            status = 'identical'
+        elif data_1 is not None and data_1 == data_2:
+            status = 'metadata_differs'
+        else:
+            status = 'data_differs'
+        rows.append((str(file_1), str(file_2), status,
+                     md5_1, md5_2, data_1, data_2))
+    return pd.DataFrame(rows, columns = ['file_1', 'file_2', 'status',
+                                         'md5_1', 'md5_2',
+                                         'data_fingerprint_1',
+                                         'data_fingerprint_2'])
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,92 @@
+'''
+Inventory of the files sorted into "<project>/<stage>/<barcode>/",
+with the GDC file_id and md5 of each file,
+to find new or changed files in a later GDC snapshot.
+'''
+import os
+from pathlib import Path
+import pandas as pd
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+INVENTORY_NAME = 'file_inventory.tsv'
+INVENTORY_COLUMNS = ['file_id', 'md5', 'original_name',
+                     'stage', 'barcode', 'file_name']
+
+
+def inventory_rows(routed, metadata_index, project_folder):
+    """Create inventory rows for sorted files.
+
+    :param routed: Dictionary of original file name -> destination path.
+    :type routed: dict
+    :param metadata_index: Index of files json and cases json.
+    :type metadata_index: MetadataIndex
+    :param project_folder: The project folder.
+    :type project_folder: Path
+    :return: The inventory rows.
+    :rtype: DataFrame
+    """
+    rows = []
+    for original_name, destination in routed.items():
+        # Only files in "<stage>/<barcode>/" are in the inventory.
+        if not Path(destination).is_relative_to(project_folder):
+            continue
+        relative = Path(destination).relative_to(project_folder)
+        if len(relative.parts) != 3:
+            continue
+        rows.append((metadata_index.file_id(original_name),
+                     metadata_index.md5(original_name),
+                     original_name) + relative.parts)
+    return pd.DataFrame(rows, columns = INVENTORY_COLUMNS)
+
+
+def read_inventory(project_folder):
+    """Read the inventory of "project_folder".
+
+    :param project_folder: The project folder.
+    :type project_folder: Path
+    :return: The inventory, None if not found.
+    :rtype: DataFrame or None
+    """
+    inventory_file = project_folder / INVENTORY_NAME
+    if not inventory_file.exists():
+        return None
+    return pd.read_table(inventory_file, dtype = str,
+                         keep_default_na = False)
+
+
+def write_inventory(project_folder, inventory):
+    """Write the inventory of "project_folder" through a temporary file.
+
+    :param project_folder: The project folder.
+    :type project_folder: Path
+    :param inventory: The inventory.
+    :type inventory: DataFrame
+    """
+    inventory_file = project_folder / INVENTORY_NAME
+    part_file = inventory_file.with_name(inventory_file.name + '.part')
+    inventory[INVENTORY_COLUMNS].to_csv(part_file, sep = '\t', index = False)
+    os.replace(part_file, inventory_file)
+
+
+def update_inventory(project_folder, rows):
+    """Add rows to the inventory of "project_folder",
+    replacing rows of the same file path.
+
+    :param project_folder: The project folder.
+    :type project_folder: Path
+    :param rows: The new inventory rows.
+    :type rows: DataFrame
+    :return: The updated inventory.
+    :rtype: DataFrame
+    """
+    inventory = read_inventory(project_folder)
+    if inventory is not None:
+        keys = ['stage', 'barcode', 'file_name']
+        kept = inventory.merge(rows[keys], on = keys, how = 'left',
+                               indicator = True)
+        inventory = inventory[(kept['_merge'] == 'left_only').to_numpy()]
+        rows = pd.concat([inventory, rows], ignore_index = True)
+    write_inventory(project_folder, rows)
+    return rows
@@ -23,7 +23,6 @@ Rename with 'submitter_id' + originl name after second '.':
     '*.gene_level_copy_number.v36.tsv'
 '''
 import os
-import sys
 import subprocess
 import re
 from pathlib import Path
@@ -32,99 +31,249 @@ import pandas as pd
 import numpy as np
 import shutil
 import json
+import gzip
+import zlib
+import tarfile
+import fnmatch
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from contextlib import nullcontext
+from gdc_metadata import load_metadata_index
+from sort_journal import Journal
+from content_store import ContentStore
+from file_inventory import inventory_rows, update_inventory
+from md5_check import (HashingReader, verify_files, check_status,
+                       write_report, REPORT_COLUMNS)
 
 __author__ = "Johnathan Lin <jagonball@gmail.com>"
 __email__ = "jagonball@gmail.com"
 
 def main():
     ### Input parameters. ###
-    project_name = 'TCGA_SKCM'
-    output_folder = Path('C:/Repositories/Melanoma_TCGA/analysis/')
-    json_files = Path('C:/Repositories/Melanoma_TCGA/data/files.2023-01-07.json')
-    json_cases = Path('C:/Repositories/Melanoma_TCGA/data/cases.2023-01-07.json')
-    # Download data is ".tar.gz" or with manifest and folders.
-    download_is_tar_gz = False
-    ## !!! Warning: download_folder must only contain
-    ## either downloaded ".tar.gz" file
-    ## or manifest file plus folders downloaded with the manifest.
-    ## Other files will be deleted by this code.
-    download_folder = Path('C:/Repositories/Melanoma_TCGA/data/0107_all/')
-    download_compressed = 'gdc_download_20230106_023217.521073.tar.gz'
-    manifest_file = 'gdc_manifest_20230107_155741.txt'
+    config = {
+        'project_name': 'TCGA_SKCM',
+        'output_folder': Path('C:/Repositories/Melanoma_TCGA/analysis/'),
+        'json_files': Path('C:/Repositories/Melanoma_TCGA/data/files.2023-01-07.json'),
+        'json_cases': Path('C:/Repositories/Melanoma_TCGA/data/cases.2023-01-07.json'),
+        # Download data is ".tar.gz" or with manifest and folders.
+        'download_is_tar_gz': False,
+        ## !!! Warning: download_folder must only contain
+        ## either downloaded ".tar.gz" file
+        ## or manifest file plus folders downloaded with the manifest.
+        ## Other files will be deleted by this code.
+        'download_folder': Path('C:/Repositories/Melanoma_TCGA/data/0107_all/'),
+        'download_compressed': 'gdc_download_20230106_023217.521073.tar.gz',
+        'manifest_file': 'gdc_manifest_20230107_155741.txt',
+        # Main data with all cases' information.
+        'main_data': Path('C:/Repositories/Melanoma_TCGA/data/clinical_patient_skcm.txt'),
+        # Resume a failed run, skip the operations in the journal.
+        'resume': False,
+    }
+    # Other parameters default to "SORT_DEFAULTS".
+    sort_project(config)
+
+
+# Default parameters of "sort_project".
+SORT_DEFAULTS = {
+    # Stream the ".tar.gz" straight into the stage/barcode folders,
+    # instead of extract, move, rename, decompress then move again.
+    'stream_tar_gz': True,
+    # Number of threads to decompress ".gz" files.
+    'decompress_workers': 4,
+    # Files to keep as ".gz", read with "open_maybe_gz" or pandas.
+    'keep_compressed': [],    # e.g. ['*.maf.gz']
+    # Check md5 and size of the downloaded files against the manifest.
+    'verify_md5': True,
+    # Keep one copy of identical files in "output_folder/content_store",
+    # hardlinked into the case folders.
+    'content_store': True,
     # Files that do not require rename.
-    files_re_list_0 = ['*.PDF',
-                       '*_RPPA_data.tsv']
+    'files_re_list_0': ['*.PDF',
+                        '*_RPPA_data.tsv'],
     # Files to rename at first '.'.
-    files_re_list_1 = ['*.wxs.aliquot_ensemble_masked.maf.gz',
-                       '*.rna_seq.augmented_star_gene_counts.tsv',
-                       '*.mirbase21.isoforms.quantification.txt',
-                       '*.mirbase21.mirnas.quantification.txt']
+    'files_re_list_1': ['*.wxs.aliquot_ensemble_masked.maf.gz',
+                        '*.rna_seq.augmented_star_gene_counts.tsv',
+                        '*.mirbase21.isoforms.quantification.txt',
+                        '*.mirbase21.mirnas.quantification.txt'],
     # Files to rename at second '.'.
-    files_re_list_2 = ['*.gene_level_copy_number.v36.tsv']
-    # Main data with all cases' information.
-    main_data = Path('C:/Repositories/Melanoma_TCGA/data/clinical_patient_skcm.txt')
-    stage_colname = 'ajcc_pathologic_tumor_stage'
-    barcode_colname = 'bcr_patient_barcode'
+    'files_re_list_2': ['*.gene_level_copy_number.v36.tsv'],
+    'stage_colname': 'ajcc_pathologic_tumor_stage',
+    'barcode_colname': 'bcr_patient_barcode',
+    'download_compressed': None,
+    'resume': False,
+}
+
+
+def sort_project(config, metadata_index = None, disk_lock = None):
+    """Sort the files downloaded for one project into
+    "output_folder/project_name/stage/barcode/".
+
+    :param config: Parameters of the project, see "main" and
+        "SORT_DEFAULTS".
+    :type config: dict
+    :param metadata_index: Index of files json and cases json,
+        defaults to loading "json_files" and "json_cases" of "config".
+    :type metadata_index: MetadataIndex, optional
+    :param disk_lock: Lock or semaphore held during disk heavy steps,
+        defaults to None
+    :type disk_lock: context manager, optional
+    """
+    config = {**SORT_DEFAULTS, **config}
+    project_name = config['project_name']
+    output_folder = Path(config['output_folder'])
+    json_files = config['json_files']
+    json_cases = config['json_cases']
+    download_is_tar_gz = config['download_is_tar_gz']
+    download_folder = Path(config['download_folder'])
+    download_compressed = config['download_compressed']
+    stream_tar_gz = config['stream_tar_gz']
+    decompress_workers = config['decompress_workers']
+    keep_compressed = config['keep_compressed']
+    verify_md5 = config['verify_md5']
+    manifest_file = config['manifest_file']
+    files_re_list_0 = config['files_re_list_0']
+    files_re_list_1 = config['files_re_list_1']
+    files_re_list_2 = config['files_re_list_2']
+    main_data = config['main_data']
+    stage_colname = config['stage_colname']
+    barcode_colname = config['barcode_colname']
+    resume = config['resume']
+    store = None
+    if config['content_store']:
+        store = ContentStore(output_folder / 'content_store')
+    if disk_lock is None:
+        disk_lock = nullcontext()
 
 
     ### Create project folder if not already exist. ###
     project_name = replace_special_chars(project_name)
     project_folder = create_folder(project_name, output_folder,
                                    verbose = True)
+    # Journal of file operations, to resume a failed run.
+    journal_file = download_folder / 'file_sorter_journal.jsonl'
+    journal = Journal(journal_file, resume = resume)
 
 
-    ### Manage downloaded file(s). ###
-    # Create "extracted" folder if not already exist.
-    extracted_folder = create_folder('extracted', download_folder,
-                                      verbose = True)
-    # Unzip downloaded ".tar.gz"
-    if download_is_tar_gz:
+    ### Single pass ingest of downloaded ".tar.gz". ###
+    if download_is_tar_gz and stream_tar_gz:
         file_check(download_compressed, 'compressed file', download_folder)
-        # Unzip compressed file to extracted_folder.
-        print(f'## Extracting "{download_compressed}" into "{extracted_folder}"...')
-        compressed_file = download_folder / download_compressed
-        subprocess.run(['tar', '-xf', compressed_file, '-C', extracted_folder])
-        # Set the "manifest_file" name.
-        manifest_file = 'MANIFEST.txt'
-    # Move the manifest file and folders to "extracted" folder.
-    else:
-        download_list = os.listdir(download_folder)
-        file_check(manifest_file, 'manifest file', download_folder)
-        # Remove "extracted" from download_list if exists.
-        if 'extracted' in download_list:
-            download_list.remove('extracted')
-        #print(len(download_list))
-        print(f'## Moving the downloaded files to "{extracted_folder}"...')
-        move_files_in_list(download_list, download_folder, extracted_folder)
-
-
-    ### Manage extracted files. ###
-    # Read the "manifest_file" for file information.
-    file_info = pd.read_table(extracted_folder / manifest_file,
-                              low_memory=False)
-    #print(file_info)
+        if metadata_index is None:
+            metadata_index = load_metadata_index(json_files, json_cases,
+                                                 verbose = True)
+        main_df = pd.read_table(main_data, sep = '\t',
+                                header = 0, skiprows = [1,2])
+        barcode_stage = build_barcode_stage(main_df, barcode_colname,
+                                            stage_colname)
+        rename_rules = [(files_re_list_0, None),
+                        (files_re_list_1, 1),
+                        (files_re_list_2, 2)]
+        temp_folder = create_folder('temp_folder', download_folder,
+                                    verbose = True)
+        print(f'## Streaming "{download_compressed}" into "{project_folder}"...')
+        digests = {}
+        failed = []
+        with disk_lock:
+            unrouted = ingest_tar_gz(download_folder / download_compressed,
+                                     project_folder, temp_folder,
+                                     metadata_index, rename_rules,
+                                     barcode_stage, download_folder,
+                                     keep_compressed = keep_compressed,
+                                     journal = journal, digests = digests,
+                                     store = store, failed = failed)
+        # Members are hashed while extracted.
+        if verify_md5:
+            rows = [(name, metadata_index.md5(Path(name).name), md5,
+                     None, size,
+                     check_status(metadata_index.md5(Path(name).name), md5))
+                    for name, (md5, size) in digests.items()
+                    if metadata_index.md5(Path(name).name) is not None]
+            write_report(pd.DataFrame(rows, columns = REPORT_COLUMNS),
+                         download_folder / 'md5_report.tsv')
+        if store is not None:
+            write_duplicates(store, download_folder / 'duplicate_files.tsv')
+        # Record sorted files in the inventory.
+        routed = {Path(src).name: dst
+                  for src, dst in journal.outputs('write').items()}
+        update_inventory(project_folder,
+                         inventory_rows(routed, metadata_index,
+                                        project_folder))
+        journal.close()
+        for name, error in failed:
+            print(f'Warning: "{name}" was not extracted ({error}), '
+                  f'download it again and resume')
+        if unrouted:
+            print(f'Warning: Files without matching case are kept in '
+                  f'"{temp_folder}"')
+        else:
+            shutil.rmtree(temp_folder)
+        return
+
+
+    ### Manage downloaded file(s). ###
     # Create 'temp_folder' folder if not already exist.
     temp_folder = create_folder('temp_folder', download_folder,
                                  verbose=True)
-    # Move the files we need to temp_folder.
     if download_is_tar_gz:
-        # Filter for state 'validated', to ignore the 'annotations.txt'.
-        file_info = file_info[file_info['state'] == 'validated']
-        #print(file_info)
-        print(f'## Moving the extracted files to "{temp_folder}"...')
-        move_files_in_list(file_info['filename'], extracted_folder, temp_folder)
-    else:
-        # Concat folder name with file name.
-        file_info['folder_file'] = file_info['id'] + '/' + file_info['filename']
-        #print(file_info['folder_file'])
-        print(f'## Moving files to "{temp_folder}"...')
-        move_files_in_list(file_info['folder_file'], extracted_folder, temp_folder)
-    # Move manifest_file to download_folder.
-    shutil.move(extracted_folder / manifest_file,
-                download_folder / manifest_file)
-    # Remove extracted_folder.
-    print(f'## Move completed, deleting folder "{extracted_folder}"...')
-    shutil.rmtree(extracted_folder) #, ignore_errors=True)
+        # Set the "manifest_file" name.
+        manifest_file = 'MANIFEST.txt'
+    # Hold the disk lock while moving the downloaded files.
+    with disk_lock:
+        if not journal.step_done('cleanup_extracted'):
+            # Create "extracted" folder if not already exist.
+            extracted_folder = create_folder('extracted', download_folder,
+                                              verbose = True)
+            # Unzip downloaded ".tar.gz"
+            if download_is_tar_gz and not journal.step_done('extract'):
+                file_check(download_compressed, 'compressed file', download_folder)
+                # Unzip compressed file to extracted_folder.
+                print(f'## Extracting "{download_compressed}" into "{extracted_folder}"...')
+                compressed_file = download_folder / download_compressed
+                subprocess.run(['tar', '-xf', compressed_file, '-C', extracted_folder])
+                journal.mark_step('extract')
+            # Move the manifest file and folders to "extracted" folder.
+            elif not download_is_tar_gz and not journal.step_done('extract'):
+                download_list = os.listdir(download_folder)
+                if not journal.resume:
+                    file_check(manifest_file, 'manifest file', download_folder)
+                # Remove folders and files of this code from download_list.
+                for name in ['extracted', 'temp_folder', journal_file.name]:
+                    if name in download_list:
+                        download_list.remove(name)
+                #print(len(download_list))
+                print(f'## Moving the downloaded files to "{extracted_folder}"...')
+                move_files_in_list(download_list, download_folder, extracted_folder,
+                                   journal = journal)
+                journal.mark_step('extract')
+
+
+            ### Manage extracted files. ###
+            # Read the "manifest_file" for file information.
+            file_info = pd.read_table(extracted_folder / manifest_file,
+                                      low_memory=False)
+            #print(file_info)
+            # Move the files we need to temp_folder.
+            if download_is_tar_gz:
+                # Filter for state 'validated', to ignore the 'annotations.txt'.
+                file_info = file_info[file_info['state'] == 'validated']
+                #print(file_info)
+                print(f'## Moving the extracted files to "{temp_folder}"...')
+                move_files_in_list(file_info['filename'], extracted_folder, temp_folder,
+                                   journal = journal)
+            else:
+                # Concat folder name with file name.
+                file_info['folder_file'] = file_info['id'] + '/' + file_info['filename']
+                #print(file_info['folder_file'])
+                print(f'## Moving files to "{temp_folder}"...')
+                move_files_in_list(file_info['folder_file'], extracted_folder, temp_folder,
+                                   journal = journal)
+            # Move manifest_file to download_folder.
+            shutil.move(extracted_folder / manifest_file,
+                        download_folder / manifest_file)
+            # Remove extracted_folder.
+            print(f'## Move completed, deleting folder "{extracted_folder}"...')
+            shutil.rmtree(extracted_folder) #, ignore_errors=True)
+            journal.mark_step('cleanup_extracted')
 
 
     ### Create a list to store target files' path. ###
@@ -148,21 +297,24 @@ def main():
 
 
     ### Rename files with case id. ###
-    # Read json files.
-    parsed_json_files = read_json(json_files)
-    print(f'Number of files in "files.json": {len(parsed_json_files)}')
-    #print(parsed_json_files[0:2])
-    parsed_json_cases = read_json(json_cases)
-    print(f'Number of cases "cases.json": {len(parsed_json_cases)}')
+    # Index json files for file_name -> case_id -> submitter_id lookup,
+    # loaded from the metadata cache unless the json files changed.
+    if metadata_index is None:
+        metadata_index = load_metadata_index(json_files, json_cases,
+                                             verbose = True)
+    print(f'Number of files in "files.json": '
+          f'{len(metadata_index.file_cases)}')
+    print(f'Number of cases "cases.json": '
+          f'{len(metadata_index.case_submitter)}')
+    print(f'Number of files with empty or more than one cases: '
+          f'{len(metadata_index.flagged)}')
     # Rename files.
-    rename_target_files(target_files_list_1, temp_folder, json_files,
-                        files_json = parsed_json_files,
-                        cases_json = parsed_json_cases,
-                        delimiter = '.', id_pos = 0, name_pos = 1)
-    rename_target_files(target_files_list_2, temp_folder, json_files,
-                        files_json = parsed_json_files,
-                        cases_json = parsed_json_cases,
-                        delimiter = '.', id_pos = 1, name_pos = 2)
+    rename_target_files(target_files_list_1, temp_folder, metadata_index,
+                        delimiter = '.', id_pos = 0, name_pos = 1,
+                        journal = journal)
+    rename_target_files(target_files_list_2, temp_folder, metadata_index,
+                        delimiter = '.', id_pos = 1, name_pos = 2,
+                        journal = journal)
 
 
     ### Decompress all .gz files. ###
@@ -170,11 +322,43 @@ def main():
     gz_list = glob(find_gz)
     #print(gz_list)
     print(f'Number of .gz files: {len(gz_list)}')
-    print(f'## Decompressing all ".gz" files...')
-    for gz in gz_list:
-        subprocess.run(['gzip', '-d', gz])
-    #all_gz = ' '.join(gz_list)
-    #subprocess.run(['gzip', '-d', all_gz])
+    # Skip the files to keep compressed.
+    gz_list = [gz for gz in gz_list
+               if not any(fnmatch.fnmatchcase(Path(gz).name, p)
+                          for p in keep_compressed)]
+    with disk_lock:
+        # Verify the other files by hashing, before decompressing.
+        if verify_md5:
+            expected = manifest_md5_lookup(download_folder / manifest_file,
+                                           temp_folder, journal)
+            gz_set = set(gz_list)
+            md5_report = verify_files({f: e for f, e in expected.items()
+                                       if str(f) not in gz_set},
+                                      workers = decompress_workers,
+                                      cache_path = download_folder /
+                                                   'md5_cache.sqlite')
+        print(f'## Decompressing {len(gz_list)} ".gz" files...')
+        decompressed = decompress_gz_files(gz_list, workers = decompress_workers,
+                                           journal = journal)
+    # ".gz" files are hashed while decompressed.
+    if verify_md5:
+        rows = []
+        for gz, result in decompressed.items():
+            if Path(gz) not in expected:
+                continue
+            expected_md5, expected_size = expected[Path(gz)]
+            if result is None:
+                rows.append((gz, expected_md5, None, expected_size, None,
+                             'not_checked'))
+            else:
+                rows.append((gz, expected_md5, result[2], expected_size,
+                             result[0], check_status(expected_md5, result[2],
+                                                     expected_size,
+                                                     result[0])))
+        md5_report = pd.concat([md5_report,
+                                pd.DataFrame(rows, columns = REPORT_COLUMNS)],
+                               ignore_index = True)
+        write_report(md5_report, download_folder / 'md5_report.tsv')
 
 
     ### Create folders based on tumor stage and case barcode, ###
@@ -187,33 +371,44 @@ def main():
     # Select tumor stage column, then reorder the unique stage values.
     unique_stages = np.sort(main_df[stage_colname].unique())
     print(f'Unique stages: {unique_stages}')
-    ## Create a folder for each tumor stage,
-    ## then for each patient create folder with bcr_patient_barcode.
-    for stage in unique_stages:
-        print(f'Working on: {stage}')
-        # Check if the stage folder exist, if not, create one.
-        stage_mod = replace_special_chars(stage)
-        #print(stage_mod)
-        stage_folder = create_folder(stage_mod, project_folder)
-        # Subset main DataFrame with specific stage.
-        stage_df = main_df[main_df[stage_colname] == stage]
-        # Iterate "bcr_patient_barcode" to create and move files.
-        for barcode in stage_df[barcode_colname]:
-            #print(barcode)
-            # Create case folder with barcode within "stage_folder".
-            case_folder = create_folder(barcode, stage_folder)
-            ## Move files from temp_folder to case_folder.
-            case_list = [f'{barcode}*']
-            case_files = search_target_files(case_list, temp_folder)
-            #print(f'Found "{len(case_files)}" files for case "{barcode}"')
-            move_files_in_list(case_files, temp_folder, case_folder)
-            
+    barcode_stage = build_barcode_stage(main_df, barcode_colname,
+                                        stage_colname)
+    ## Scan "temp_folder" once, create a folder for each tumor stage
+    ## and patient, then move the files by barcode prefix.
+    print(f'## Moving files from "{temp_folder}" into "{project_folder}"...')
+    with disk_lock:
+        unrouted = route_files(temp_folder, project_folder, barcode_stage,
+                               journal = journal, store = store)
+    if store is not None:
+        write_duplicates(store, download_folder / 'duplicate_files.tsv')
+
+    ### Record sorted files in the inventory, with original names. ###
+    renamed = {Path(dst).name: Path(src).name
+               for src, dst in journal.outputs('rename').items()}
+    routed = {}
+    sorted_files = list(journal.outputs('move').values()) + \
+                   list(journal.outputs('store').values())
+    for dst in sorted_files:
+        name = Path(dst).name
+        # Decompressed files were renamed with ".gz".
+        original = renamed.get(name, renamed.get(name + '.gz', name))
+        routed[original] = dst
+    update_inventory(project_folder,
+                     inventory_rows(routed, metadata_index, project_folder))
+    journal.close()
+
     # Remove temp_folder if all files are moved.
-    if glob(str(temp_folder / '*')) == []:
+    if not unrouted:
         print(f'## Move completed, deleting folder "{temp_folder}"...')
         shutil.rmtree(temp_folder) #, ignore_errors=True)
     else:
-        print(f'Warning: Move incomplete, please check folder "{temp_folder}"')
+        report_file = download_folder / 'unrouted_files.txt'
+        with open(report_file, 'w') as f:
+            for file_name in unrouted:
+                f.write(f'{file_name}\n')
+        print(f'Warning: {len(unrouted)} files match no case barcode, '
+              f'listed in "{report_file}", '
+              f'please check folder "{temp_folder}"')
 
 
 def create_folder(folder_name, path_to_folder, verbose = False):
@@ -230,7 +425,7 @@ def create_folder(folder_name, path_to_folder, verbose = False):
     if verbose:
         print(f'Checking if folder "{folder_name}" '
               f'exists in "{path_to_folder}"...')
-    if folder_name not in os.listdir(path_to_folder):
+    if not final_folder.exists():
         if verbose:
             print(f'## Folder "{folder_name}" not found, creating...')
         os.mkdir(final_folder) 
@@ -250,7 +445,7 @@ def replace_special_chars(str):
     return mod_str
 
 
-def move_files_in_list(files_list, from_folder, to_folder):
+def move_files_in_list(files_list, from_folder, to_folder, journal = None):
     """Move files in the list or Series, from "from_folder" to "to_folder".
     
     :param files_list: A list or Series of file names.
@@ -259,13 +454,61 @@ def move_files_in_list(files_list, from_folder, to_folder):
     :type from_folder: Path
     :param to_folder: The destination folder path.
     :type to_folder: Path
+    :param journal: Journal to record and skip moves, defaults to None
+    :type journal: Journal, optional
     """
     for file in files_list:
         #print(file)
         file_name = Path(file).name
         #print(f'file_name: {file_name}')
-        shutil.move(from_folder / file,
-                    to_folder / file_name)
+        if journal is None:
+            shutil.move(from_folder / file,
+                        to_folder / file_name)
+        else:
+            journal.run('move', from_folder / file, to_folder / file_name,
+                        partial(shutil.move, from_folder / file,
+                                to_folder / file_name))
+
+
+def store_files_in_list(files_list, from_folder, to_folder, store,
+                        journal = None):
+    """Move files in the list into the content store,
+    then hardlink them from "to_folder".
+
+    :param files_list: A list of file names.
+    :type files_list: list
+    :param from_folder: The original folder path.
+    :type from_folder: Path
+    :param to_folder: The destination folder path.
+    :type to_folder: Path
+    :param store: The content store.
+    :type store: ContentStore
+    :param journal: Journal to record and skip files, defaults to None
+    :type journal: Journal, optional
+    """
+    for file in files_list:
+        src = from_folder / file
+        if journal is not None and journal.is_done('store', src) is not None:
+            continue
+        dst = store.place(src, to_folder / Path(file).name)
+        if journal is not None:
+            journal.record('store', src, dst)
+
+
+def write_duplicates(store, report_file):
+    """Write the true duplicates found by the content store.
+
+    :param store: The content store.
+    :type store: ContentStore
+    :param report_file: Path to write the table.
+    :type report_file: Path
+    """
+    duplicates = pd.DataFrame(store.duplicates,
+                              columns = ['file_name', 'case_folder',
+                                         'identical_to'])
+    duplicates.to_csv(report_file, sep = '\t', index = False)
+    print(f'Number of byte-identical duplicate files: {len(duplicates)}, '
+          f'listed in "{report_file}"')
 
 
 def file_check(file, file_type, folder):
@@ -277,11 +520,14 @@ def file_check(file, file_type, folder):
     :type file_type: str
     :param folder: The folder to look for.
     :type folder: Path or str
+    :raises FileNotFoundError: If the file is not in the folder, so a
+        project sorted in a worker process fails alone.
     """
     if file not in os.listdir(folder):
         print(f'Error: Cannot find the {file_type} '
               f'"{file}", please check again.')
-        sys.exit()
+        raise FileNotFoundError(f'Cannot find the {file_type} "{file}" '
+                                f'in "{folder}"')
 
 
 def read_json(json_file):
@@ -316,9 +562,9 @@ def search_target_files(file_list, folder_path):
 
 
 # Potential problem with more than 1 suffixes. e.g. "*.tar.gz"
-def rename_target_files(files_list, folder_path, json_files,
-                        files_json, cases_json,
-                        delimiter = '.', id_pos = 0, name_pos = 1):
+def rename_target_files(files_list, folder_path, metadata_index,
+                        delimiter = '.', id_pos = 0, name_pos = 1,
+                        journal = None):
     """Rename files in "files_list" within "folder_path", 
     based on information of two json files.
 
@@ -326,72 +572,451 @@ def rename_target_files(files_list, folder_path, json_files,
     :type files_list: list
     :param folder_path: Folder path of the files.
     :type folder_path: Path or str
-    :param json_files: File path of json files.
-    :type json_files: Path or str
-    :param files_json: Parsed files json.
-    :type files_json: list
-    :param cases_json: Parsed cases json.
-    :type cases_json: list
+    :param metadata_index: Index of files json and cases json.
+    :type metadata_index: MetadataIndex
     :param delimiter: Delimiter of file name, defaults to '.'
     :type delimiter: str, optional
     :param id_pos: Position of "ID" of the specified delimiter, defaults to 0
     :type id_pos: int, optional
     :param name_pos: Position of "Name to keep" of the specified delimiter, defaults to 1
     :type name_pos: int, optional
+    :param journal: Journal to record renames and skip renamed files,
+        defaults to None
+    :type journal: Journal, optional
     """
     for i in files_list:
         target_file_name = Path(i).name
+        # Already renamed in the run being resumed.
+        if journal is not None and \
+           journal.is_produced(folder_path / target_file_name, 'rename'):
+            continue
         # Files to keep the name after first ".".
         file_id = target_file_name.split(delimiter)[id_pos]
         #print(file_id)
         name_keep = target_file_name.split(delimiter)[name_pos:]
         name_keep = delimiter.join(name_keep)
         #print(name_keep)
-        # Iterate files_json for matching file_name.
-        target_case_id = next((dict['cases'][0]['case_id']\
-                               for dict in files_json\
-                               if dict['file_name'] == target_file_name),
-                              None)
-        target_submitter_id = next((dict['submitter_id']\
-                                    for dict in cases_json\
-                                    if dict['case_id'] == target_case_id),
-                                   None)
-    #    # Iterate files_json for matching file_name.
-    #    target_case_id = None
-    #    target_submitter_id = None
-    #    for i in files_json:
-    #        if i['file_name'] == target_file_name:
-    #            #print(i)
-    #            if len(i['cases']) != 1:
-    #                print(f'Warning: list "cases" for file '
-    #                      f'"{target_file_name}" in "{json_files}" '
-    #                      f'are empty or more than one items')
-    #            target_case_id = i['cases'][0]['case_id']
-    #            #print(target_case_id)
-    #            for i in cases_json:
-    #                if i['case_id'] == target_case_id:
-    #                    #print(i)
-    #                    target_submitter_id = i['submitter_id']
-    #                    #print(target_submitter_id)
+        # Look up submitter_id with the metadata index.
+        target_submitter_id = metadata_index.submitter_id(target_file_name)
         # Rename target file if there's match.
         if target_submitter_id:
             old_name = folder_path / target_file_name
             new_name = folder_path / f'{target_submitter_id}.{name_keep}'
             #if not new_name.exists():
             #    os.rename(old_name, new_name)
-            dupe_count = 1
-            while new_name.exists():
-                dupe_count += 1
-                print(f'Attention: File name "{new_name}" already exists, '
-                      f'attempting rename...')
-                file_name = new_name.stem + f'_{dupe_count}' + new_name.suffix
-                new_name = folder_path / file_name
-                #print(new_name)
-            else:
+            new_name = unique_file_path(new_name)
+            if journal is None:
                 os.rename(old_name, new_name)
+            else:
+                journal.run('rename', old_name, new_name,
+                            partial(os.rename, old_name, new_name))
         else:
             print(f'Error: Match not found for file "{i}"')
 
 
+
+def unique_file_path(new_name):
+    """Append "_2", "_3"... to the file name until it does not exist.
+
+    :param new_name: The wanted file path.
+    :type new_name: Path
+    :return: A file path that does not exist yet.
+    :rtype: Path
+    """
+    dupe_count = 1
+    while new_name.exists():
+        dupe_count += 1
+        print(f'Attention: File name "{new_name}" already exists, '
+              f'attempting rename...')
+        file_name = new_name.stem + f'_{dupe_count}' + new_name.suffix
+        new_name = new_name.parent / file_name
+    return new_name
+
+
+def resolve_target_name(file_name, metadata_index, rename_rules,
+                        delimiter = '.', warn = True):
+    """Resolve the name a downloaded file gets in the sorted layout,
+    same as "rename_target_files" but without touching the file.
+
+    :param file_name: The original file name.
+    :type file_name: str
+    :param metadata_index: Index of files json and cases json.
+    :type metadata_index: MetadataIndex
+    :param rename_rules: List of (file name patterns, name_pos),
+        name_pos None for files that do not require rename.
+    :type rename_rules: list
+    :param delimiter: Delimiter of file name, defaults to '.'
+    :type delimiter: str, optional
+    :param warn: Print a warning for flagged files, defaults to True
+    :type warn: bool, optional
+    :return: The new file name, None if no rule or metadata matches.
+    :rtype: str or None
+    """
+    for patterns, name_pos in rename_rules:
+        if not any(fnmatch.fnmatchcase(file_name, p) for p in patterns):
+            continue
+        if name_pos is None:
+            return file_name
+        submitter_id = metadata_index.submitter_id(file_name, warn = warn)
+        if submitter_id is None:
+            return None
+        name_keep = delimiter.join(file_name.split(delimiter)[name_pos:])
+        return f'{submitter_id}{delimiter}{name_keep}'
+    return None
+
+
+def build_barcode_index(barcodes):
+    """Index case barcodes by length for prefix matching of file names.
+
+    :param barcodes: Case barcodes, e.g. "bcr_patient_barcode" column.
+    :type barcodes: iterable
+    :return: Dictionary of barcode length -> set of barcodes,
+        longest first.
+    :rtype: dict
+    """
+    barcode_index = {}
+    for barcode in barcodes:
+        barcode_index.setdefault(len(barcode), set()).add(barcode)
+    return dict(sorted(barcode_index.items(), reverse = True))
+
+
+def match_barcode(file_name, barcode_index):
+    """Find the case barcode "file_name" starts with.
+
+    :param file_name: The file name.
+    :type file_name: str
+    :param barcode_index: Output of "build_barcode_index".
+    :type barcode_index: dict
+    :return: The barcode, None if no barcode matches.
+    :rtype: str or None
+    """
+    for length, barcodes in barcode_index.items():
+        if file_name[:length] in barcodes:
+            return file_name[:length]
+    return None
+
+
+def build_barcode_stage(main_df, barcode_colname, stage_colname):
+    """Map each case barcode to its stage folder name.
+
+    :param main_df: Main data with all cases' information.
+    :type main_df: DataFrame
+    :param barcode_colname: Column name of case barcode.
+    :type barcode_colname: str
+    :param stage_colname: Column name of tumor stage.
+    :type stage_colname: str
+    :return: Dictionary of barcode -> stage folder name.
+    :rtype: dict
+    """
+    return {barcode: replace_special_chars(stage)
+            for barcode, stage in zip(main_df[barcode_colname],
+                                      main_df[stage_colname])}
+
+
+def route_files(from_folder, project_folder, barcode_stage, journal = None,
+                store = None):
+    """Move files in "from_folder" into "project_folder/stage/barcode/"
+    by the case barcode each file name starts with.
+    The folder is scanned once and all stage and case folders
+    are created in one pass.
+
+    :param from_folder: The folder with renamed files.
+    :type from_folder: Path
+    :param project_folder: The project folder.
+    :type project_folder: Path
+    :param barcode_stage: Dictionary of barcode -> stage folder name.
+    :type barcode_stage: dict
+    :param journal: Journal to record and skip moves, defaults to None
+    :type journal: Journal, optional
+    :param store: Content store to keep files in and hardlink from,
+        defaults to None
+    :type store: ContentStore, optional
+    :return: List of file names that match no barcode.
+    :rtype: list
+    """
+    barcode_index = build_barcode_index(barcode_stage)
+    # Create all stage and case folders.
+    for barcode, stage in barcode_stage.items():
+        os.makedirs(project_folder / stage / barcode, exist_ok = True)
+    # Scan "from_folder" once and group files by barcode.
+    case_files = {}
+    unrouted = []
+    with os.scandir(from_folder) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            barcode = match_barcode(entry.name, barcode_index)
+            if barcode is None:
+                unrouted.append(entry.name)
+            else:
+                case_files.setdefault(barcode, []).append(entry.name)
+    # Move files case by case.
+    for barcode, files_list in case_files.items():
+        case_folder = project_folder / barcode_stage[barcode] / barcode
+        if store is None:
+            move_files_in_list(files_list, from_folder, case_folder,
+                               journal = journal)
+        else:
+            # Sorted, so "name.tsv" is stored before "name_2.tsv".
+            store_files_in_list(sorted(files_list), from_folder, case_folder,
+                                store, journal = journal)
+    print(f'Number of files moved: '
+          f'{sum(len(f) for f in case_files.values())} '
+          f'into {len(case_files)} cases, '
+          f'without matching case: {len(unrouted)}')
+    return sorted(unrouted)
+
+
+def ingest_tar_gz(compressed_file, project_folder, unrouted_folder,
+                  metadata_index, rename_rules, barcode_stage,
+                  manifest_folder, keep_compressed = (),
+                  chunk_size = 1 << 20, journal = None, digests = None,
+                  store = None, failed = None):
+    """Stream members of the downloaded ".tar.gz" straight into
+    "project_folder/stage/barcode/", renamed and with inner ".gz"
+    decompressed, so each file is written to disk once.
+
+    :param compressed_file: Path to the downloaded ".tar.gz".
+    :type compressed_file: Path
+    :param project_folder: The project folder.
+    :type project_folder: Path
+    :param unrouted_folder: Folder for files without a matching case.
+    :type unrouted_folder: Path
+    :param metadata_index: Index of files json and cases json.
+    :type metadata_index: MetadataIndex
+    :param rename_rules: See "resolve_target_name".
+    :type rename_rules: list
+    :param barcode_stage: Dictionary of case barcode -> stage folder name.
+    :type barcode_stage: dict
+    :param manifest_folder: Folder to write "MANIFEST.txt" into.
+    :type manifest_folder: Path
+    :param keep_compressed: Patterns of ".gz" files not to decompress,
+        defaults to ()
+    :type keep_compressed: list, optional
+    :param chunk_size: Bytes to copy each time, defaults to 1 MiB
+    :type chunk_size: int, optional
+    :param journal: Journal to record and skip written members,
+        defaults to None
+    :type journal: Journal, optional
+    :param digests: Dictionary to fill with member name -> (md5, size)
+        of the bytes in the archive, defaults to None
+    :type digests: dict, optional
+    :param store: Content store to keep routed files in and hardlink
+        from, defaults to None
+    :type store: ContentStore, optional
+    :param failed: List to fill with (member name, error) of members
+        that failed to extract, defaults to None
+    :type failed: list, optional
+    :return: List of file paths written into "unrouted_folder".
+    :rtype: list
+    """
+    barcode_index = build_barcode_index(barcode_stage)
+    created_folders = set()
+    unrouted = []
+    file_count = 0
+    with tarfile.open(compressed_file, 'r|gz') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            # Written in the run being resumed.
+            if journal is not None:
+                done_path = journal.is_done('write', member.name)
+                if done_path is not None:
+                    if done_path.parent == unrouted_folder:
+                        unrouted.append(done_path)
+                    continue
+            file_name = Path(member.name).name
+            if file_name == 'MANIFEST.txt':
+                destination = manifest_folder / file_name
+            elif file_name == 'annotations.txt':
+                continue
+            else:
+                new_name = resolve_target_name(file_name, metadata_index,
+                                               rename_rules)
+                barcode = None
+                if new_name is None:
+                    print(f'Error: Match not found for file "{member.name}"')
+                    new_name = file_name
+                else:
+                    barcode = match_barcode(new_name, barcode_index)
+                if barcode is None:
+                    destination = unrouted_folder / new_name
+                else:
+                    destination = (project_folder / barcode_stage[barcode]
+                                   / barcode / new_name)
+            # Decompress inner ".gz" on the fly.
+            decompress = (destination.suffix == '.gz'
+                          and not any(fnmatch.fnmatchcase(destination.name, p)
+                                      for p in keep_compressed))
+            if decompress:
+                destination = destination.with_suffix('')
+            if destination.parent not in created_folders:
+                os.makedirs(destination.parent, exist_ok = True)
+                created_folders.add(destination.parent)
+            if file_name != 'MANIFEST.txt':
+                destination = unique_file_path(destination)
+            raw = HashingReader(tar.extractfile(member))
+            stream = gzip.GzipFile(fileobj = raw) if decompress else raw
+            part_file = destination.with_name(destination.name + '.part')
+            try:
+                try:
+                    with stream, open(part_file, 'wb') as out:
+                        shutil.copyfileobj(stream, out, chunk_size)
+                        while raw.read(chunk_size):
+                            pass
+                except BaseException:
+                    # Do not leave a partially written file behind.
+                    part_file.unlink(missing_ok = True)
+                    raise
+            except (OSError, EOFError, zlib.error) as e:
+                # A corrupt inner ".gz", not journaled so resume retries it.
+                print(f'Error: Failed to extract "{member.name}": {e}')
+                if failed is not None:
+                    failed.append((member.name, str(e)))
+                continue
+            os.replace(part_file, destination)
+            if digests is not None:
+                digests[member.name] = (raw.hexdigest(), raw.bytes_read)
+            if store is not None and destination.parent != unrouted_folder:
+                # May return an identical file already in the case folder.
+                destination = store.place(destination, destination)
+            if journal is not None:
+                journal.record('write', member.name, destination)
+            if destination.parent == unrouted_folder:
+                unrouted.append(destination)
+            file_count += 1
+    print(f'Number of files written: {file_count}, '
+          f'without matching case: {len(unrouted)}')
+    if failed:
+        print(f'Number of files failed: {len(failed)}')
+    return unrouted
+
+
+
+def decompress_gz(gz_file, chunk_size = 1 << 20):
+    """Decompress one ".gz" file in chunks,
+    write through a temporary file then delete the ".gz".
+
+    :param gz_file: Path to the ".gz" file.
+    :type gz_file: Path or str
+    :param chunk_size: Bytes to copy each time, defaults to 1 MiB
+    :type chunk_size: int, optional
+    :return: Bytes read, bytes written and md5 of the ".gz".
+    :rtype: tuple
+    """
+    gz_file = Path(gz_file)
+    out_file = gz_file.with_suffix('')
+    part_file = out_file.with_name(out_file.name + '.part')
+    try:
+        # Hash the compressed bytes while decompressing.
+        with HashingReader(open(gz_file, 'rb')) as raw, \
+             gzip.GzipFile(fileobj = raw) as stream, \
+             open(part_file, 'wb') as out:
+            shutil.copyfileobj(stream, out, chunk_size)
+            # Hash trailing bytes gzip did not need to read.
+            while raw.read(chunk_size):
+                pass
+    except BaseException:
+        # Do not leave a partially written file behind.
+        part_file.unlink(missing_ok = True)
+        raise
+    os.replace(part_file, out_file)
+    bytes_in = gz_file.stat().st_size
+    os.remove(gz_file)
+    return bytes_in, out_file.stat().st_size, raw.hexdigest()
+
+
+def decompress_gz_files(gz_list, workers = 4, chunk_size = 1 << 20,
+                        journal = None):
+    """Decompress ".gz" files with a pool of threads,
+    zlib releases the GIL so threads use multiple cores.
+
+    :param gz_list: List of ".gz" file paths.
+    :type gz_list: list
+    :param workers: Number of threads, defaults to 4
+    :type workers: int, optional
+    :param chunk_size: Bytes to copy each time, defaults to 1 MiB
+    :type chunk_size: int, optional
+    :param journal: Journal to record and skip decompression,
+        defaults to None
+    :type journal: Journal, optional
+    :return: Dictionary of ".gz" file -> (bytes read, bytes written, md5),
+        None for files failed or skipped by the journal.
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    total_in = total_out = 0
+    results = {}
+    def task(gz):
+        if journal is None:
+            return decompress_gz(gz, chunk_size)
+        result = []
+        journal.run('decompress', gz, Path(gz).with_suffix(''),
+                    lambda: result.append(decompress_gz(gz, chunk_size)))
+        return result[0] if result else None
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = {executor.submit(task, gz): gz
+                   for gz in gz_list}
+        for future in as_completed(futures):
+            gz = futures[future]
+            try:
+                results[gz] = future.result()
+            except (OSError, EOFError, zlib.error) as e:
+                print(f'Error: Failed to decompress "{gz}": {e}')
+                results[gz] = None
+                continue
+            if results[gz] is not None:
+                total_in += results[gz][0]
+                total_out += results[gz][1]
+    seconds = max(time.perf_counter() - start, 1e-9)
+    print(f'Decompressed {total_in / 1e6:.1f} MB into '
+          f'{total_out / 1e6:.1f} MB in {seconds:.1f} s '
+          f'({total_out / 1e6 / seconds:.1f} MB/s)')
+    return results
+
+
+def manifest_md5_lookup(manifest_path, folder_path, journal = None):
+    """Map files in "folder_path" to their md5 and size in the manifest,
+    using the original names of renamed files from the journal.
+
+    :param manifest_path: Path to the manifest file.
+    :type manifest_path: Path
+    :param folder_path: Folder with the downloaded files.
+    :type folder_path: Path
+    :param journal: Journal with the renames, defaults to None
+    :type journal: Journal, optional
+    :return: Dictionary of file path -> (md5, size).
+    :rtype: dict
+    """
+    manifest = pd.read_table(manifest_path, low_memory=False)
+    manifest_md5 = dict(zip(manifest['filename'],
+                            zip(manifest['md5'], manifest['size'])))
+    original_names = {}
+    if journal is not None:
+        original_names = {Path(dst).name: Path(src).name for src, dst
+                          in journal.outputs('rename').items()}
+    expected = {}
+    for file_path in folder_path.iterdir():
+        original = original_names.get(file_path.name, file_path.name)
+        if original in manifest_md5:
+            expected[file_path] = manifest_md5[original]
+    return expected
+
+
+def open_maybe_gz(file_path, mode = 'rt'):
+    """Open a file, transparently decompressing it if it ends with ".gz".
+
+    :param file_path: Path to the file.
+    :type file_path: Path or str
+    :param mode: Open mode, defaults to 'rt'
+    :type mode: str, optional
+    :return: The file object.
+    :rtype: file object
+    """
+    if str(file_path).endswith('.gz'):
+        return gzip.open(file_path, mode)
+    return open(file_path, mode)
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,279 @@
+'''
+Index of the GDC "files.json" and "cases.json" exports.
+Built once, then look up "case_id" and "submitter_id" by file name
+with dictionaries instead of scanning the parsed json for every file.
+
+The fields used by the pipeline are cached in a SQLite file,
+keyed by the path, size and mtime of both json files,
+so later runs skip parsing the json.
+'''
+import os
+import json
+import sqlite3
+from pathlib import Path
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+# Bump when the cache tables change.
+CACHE_VERSION = 2
+
+
+class MetadataIndex:
+    """Lookup tables for GDC file and case metadata.
+
+    :param files_json: Parsed files json, or an iterator of its records.
+    :type files_json: list or iterator
+    :param cases_json: Parsed cases json, or an iterator of its records.
+    :type cases_json: list or iterator
+    :param json_files: File path of files json, only used in warnings.
+    :type json_files: Path or str, optional
+    """
+    def __init__(self, files_json, cases_json, json_files = None):
+        self.json_files = json_files
+        # file_name -> list of case_id.
+        self.file_cases = {}
+        # file_name -> (file_id, md5, data_type, aliquot).
+        self.file_info = {}
+        for record in files_json:
+            case_ids = [case['case_id'] for case in record.get('cases', [])]
+            self.file_cases[record['file_name']] = case_ids
+            self.file_info[record['file_name']] = (record.get('file_id'),
+                                                   record.get('md5sum'),
+                                                   record.get('data_type'),
+                                                   _aliquot(record))
+        # case_id -> submitter_id.
+        self.case_submitter = {record['case_id']: record['submitter_id']
+                               for record in cases_json}
+        self._flag_files()
+
+    @classmethod
+    def from_rows(cls, file_rows, case_rows, json_files = None):
+        """Build the index from flat rows, e.g. from the SQLite cache.
+
+        :param file_rows: Rows of (file_name, file_id, case_id, md5,
+            data_type, aliquot), one row per case, case_id None for no case.
+        :type file_rows: iterable
+        :param case_rows: Rows of (case_id, submitter_id).
+        :type case_rows: iterable
+        :param json_files: File path of files json, only used in warnings.
+        :type json_files: Path or str, optional
+        :return: The metadata index.
+        :rtype: MetadataIndex
+        """
+        index = cls([], [], json_files = json_files)
+        for file_name, file_id, case_id, md5, data_type, aliquot \
+                in file_rows:
+            case_ids = index.file_cases.setdefault(file_name, [])
+            if case_id is not None:
+                case_ids.append(case_id)
+            index.file_info[file_name] = (file_id, md5, data_type, aliquot)
+        index.case_submitter = dict(case_rows)
+        index._flag_files()
+        return index
+
+    def _flag_files(self):
+        # Files with "cases" empty or more than one items.
+        self.flagged = {name: ids for name, ids in self.file_cases.items()
+                        if len(ids) != 1}
+
+    def case_ids(self, file_name):
+        """Return all case_id of a file.
+
+        :param file_name: The original file name in files json.
+        :type file_name: str
+        :return: List of case_id, empty if the file is not found.
+        :rtype: list
+        """
+        return self.file_cases.get(file_name, [])
+
+    def case_id(self, file_name, warn = True):
+        """Return the first case_id of a file.
+
+        :param file_name: The original file name in files json.
+        :type file_name: str
+        :param warn: Print a warning for flagged files, defaults to True
+        :type warn: bool, optional
+        :return: The case_id, None if not found.
+        :rtype: str or None
+        """
+        case_ids = self.case_ids(file_name)
+        if warn and file_name in self.flagged:
+            print(f'Warning: list "cases" for file '
+                  f'"{file_name}" in "{self.json_files}" '
+                  f'are empty or more than one items')
+        if case_ids:
+            return case_ids[0]
+        return None
+
+    def submitter_id(self, file_name, warn = True):
+        """Return the submitter_id of the first case of a file.
+
+        :param file_name: The original file name in files json.
+        :type file_name: str
+        :param warn: Print a warning for flagged files, defaults to True
+        :type warn: bool, optional
+        :return: The submitter_id, None if not found.
+        :rtype: str or None
+        """
+        return self.case_submitter.get(self.case_id(file_name, warn = warn))
+
+    def file_id(self, file_name):
+        """Return the GDC file_id of a file, None if not found."""
+        return self.file_info.get(file_name, _NO_INFO)[0]
+
+    def md5(self, file_name):
+        """Return the md5sum of a file, None if not found."""
+        return self.file_info.get(file_name, _NO_INFO)[1]
+
+    def data_type(self, file_name):
+        """Return the data_type of a file, None if not found."""
+        return self.file_info.get(file_name, _NO_INFO)[2]
+
+    def aliquot(self, file_name):
+        """Return the aliquot barcode of a file, e.g.
+        "TCGA-XX-XXXX-06A-11R-A18T-07", None if not found."""
+        return self.file_info.get(file_name, _NO_INFO)[3]
+
+
+_NO_INFO = (None, None, None, None)
+
+
+def _aliquot(record):
+    # Aliquot barcode from "associated_entities" of a files json record.
+    for entity in record.get('associated_entities', []):
+        if entity.get('entity_type', 'aliquot') == 'aliquot':
+            return entity.get('entity_submitter_id')
+    return None
+
+
+def iter_json_array(json_file, chunk_size = 1 << 20):
+    """Iterate the items of a json array one at a time,
+    reading the file in chunks so memory stays bounded by the largest item.
+
+    :param json_file: Path to json file with an array at top level.
+    :type json_file: Path or str
+    :param chunk_size: Characters to read each time, defaults to 1 MiB
+    :type chunk_size: int, optional
+    :yield: Parsed items of the array.
+    :rtype: dict
+    """
+    decoder = json.JSONDecoder()
+    with open(json_file) as file:
+        buffer = file.read(chunk_size).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f'"{json_file}" is not a json array')
+        pos = 1
+        eof = False
+        while True:
+            # Skip white spaces and "," between items.
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                if pos >= len(buffer):
+                    raise json.JSONDecodeError('Need more data', buffer, pos)
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # Item incomplete, drop the parsed part and read more.
+                chunk = file.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+            pos = end
+
+
+def _file_rows(json_files):
+    for record in iter_json_array(json_files):
+        row = (record['file_name'], record.get('file_id'))
+        tail = (record.get('md5sum'), record.get('data_type'),
+                _aliquot(record))
+        cases = record.get('cases', [])
+        if not cases:
+            yield row + (None,) + tail
+        for case in cases:
+            yield row + (case['case_id'],) + tail
+
+
+def _case_rows(json_cases):
+    for record in iter_json_array(json_cases):
+        yield record['case_id'], record['submitter_id']
+
+
+def _source_key(json_file):
+    stat = os.stat(json_file)
+    return str(Path(json_file).resolve()), stat.st_size, stat.st_mtime_ns
+
+
+def load_metadata_index(json_files, json_cases, cache_path = None,
+                        verbose = False):
+    """Load the metadata index from the SQLite cache,
+    (re)build the cache first if either json file changed.
+
+    :param json_files: Path to files json.
+    :type json_files: Path or str
+    :param json_cases: Path to cases json.
+    :type json_cases: Path or str
+    :param cache_path: Path to the cache, defaults to
+        "gdc_metadata_cache.sqlite" next to "json_files".
+    :type cache_path: Path or str, optional
+    :param verbose: Print cache status, defaults to False
+    :type verbose: bool, optional
+    :return: The metadata index.
+    :rtype: MetadataIndex
+    """
+    if cache_path is None:
+        cache_path = Path(json_files).parent / 'gdc_metadata_cache.sqlite'
+    sources = [('files', ) + _source_key(json_files),
+               ('cases', ) + _source_key(json_cases)]
+    con = sqlite3.connect(cache_path)
+    try:
+        if _cache_is_current(con, sources):
+            if verbose:
+                print(f'## Loading metadata cache "{cache_path}"...')
+        else:
+            if verbose:
+                print(f'## Building metadata cache "{cache_path}"...')
+            _build_cache(con, json_files, json_cases, sources)
+        file_rows = con.execute('SELECT file_name, file_id, case_id, '
+                                'md5, data_type, aliquot FROM files')
+        case_rows = con.execute('SELECT case_id, submitter_id FROM cases')
+        return MetadataIndex.from_rows(file_rows, case_rows,
+                                       json_files = json_files)
+    finally:
+        con.close()
+
+
+def _cache_is_current(con, sources):
+    try:
+        version = con.execute('PRAGMA user_version').fetchone()[0]
+        cached = con.execute('SELECT name, path, size, mtime '
+                             'FROM sources ORDER BY name').fetchall()
+    except sqlite3.DatabaseError:
+        return False
+    return version == CACHE_VERSION and cached == sorted(sources)
+
+
+def _build_cache(con, json_files, json_cases, sources):
+    with con:
+        con.execute('DROP TABLE IF EXISTS sources')
+        con.execute('DROP TABLE IF EXISTS files')
+        con.execute('DROP TABLE IF EXISTS cases')
+        con.execute('CREATE TABLE sources (name TEXT PRIMARY KEY, '
+                    'path TEXT, size INTEGER, mtime INTEGER)')
+        con.execute('CREATE TABLE files (file_name TEXT, file_id TEXT, '
+                    'case_id TEXT, md5 TEXT, data_type TEXT, '
+                    'aliquot TEXT)')
+        con.execute('CREATE TABLE cases (case_id TEXT PRIMARY KEY, '
+                    'submitter_id TEXT)')
+        con.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                        _file_rows(json_files))
+        con.executemany('INSERT OR REPLACE INTO cases VALUES (?, ?)',
+                        _case_rows(json_cases))
+        con.executemany('INSERT INTO sources VALUES (?, ?, ?, ?)', sources)
+        con.execute(f'PRAGMA user_version = {CACHE_VERSION}')
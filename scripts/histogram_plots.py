@@ -0,0 +1,73 @@
+'''
+Histograms of expression values, rendered with the "Agg" backend
+in a process pool. Every figure is closed after saving.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import seaborn as sns
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+def histogram(df, x, save_path, name):
+    """Save the histogram of column "x" as "hist_<x><name>.png"."""
+    fig, ax1 = plt.subplots()
+    try:
+        sns.histplot(df, x=x, ax=ax1)
+        fig.tight_layout() ### Rescale the fig size to fit the data
+        fig.savefig(f'{save_path}/hist_{x}{name}.png')
+    finally:
+        plt.close(fig)
+
+
+def histogram_panel(df, columns, save_path, name):
+    """Save the histograms of all "columns" in one figure
+    as "hist{name}.png"."""
+    fig, axes = plt.subplots(1, len(columns), squeeze = False,
+                             figsize = (5 * len(columns), 4))
+    try:
+        for x, ax in zip(columns, axes[0]):
+            sns.histplot(df, x=x, ax=ax)
+        fig.tight_layout()
+        fig.savefig(f'{save_path}/hist{name}.png')
+    finally:
+        plt.close(fig)
+
+
+def _render(task, multi_panel, style):
+    df, columns, save_path, name = task
+    with plt.style.context(style):
+        if multi_panel:
+            histogram_panel(df, columns, save_path, name)
+        else:
+            for x in columns:
+                histogram(df, x, save_path, name)
+    return save_path, name
+
+
+def render_histograms(tasks, workers = 4, multi_panel = False,
+                      style = 'ggplot'):
+    """Render the histograms of many genes in parallel.
+
+    :param tasks: List of (df, columns, save_path, name),
+        "name" is added to the file names, e.g. '_rm0'.
+    :type tasks: list
+    :param workers: Number of worker processes, defaults to 4
+    :type workers: int, optional
+    :param multi_panel: One figure with all columns for each task,
+        defaults to False for one figure for each column
+    :type multi_panel: bool, optional
+    :param style: Matplotlib style, defaults to 'ggplot'
+    :type style: str, optional
+    """
+    # Send only the columns to plot to the workers.
+    tasks = [(df[list(columns)], columns, save_path, name)
+             for df, columns, save_path, name in tasks]
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        futures = [executor.submit(_render, task, multi_panel, style)
+                   for task in tasks]
+        for future in futures:
+            save_path, name = future.result()
+            print(f'Writing histograms: "{save_path}/hist*{name}.png"...')
@@ -0,0 +1,217 @@
+'''
+Refresh a sorted project with a new GDC snapshot.
+Compare the new manifest with the files already in
+"<project>/<stage>/<barcode>/" by file_id and md5,
+write a manifest of the new or changed files only,
+and move case folders whose tumor stage changed in the clinical table.
+
+Download the delta manifest with gdc-client,
+then sort it with "file_sorter.py" into the same project folder.
+'''
+import os
+import shutil
+from pathlib import Path
+import pandas as pd
+from file_sorter import (create_folder, replace_special_chars,
+                         resolve_target_name, build_barcode_stage)
+from file_inventory import read_inventory, write_inventory, INVENTORY_COLUMNS
+from gdc_metadata import load_metadata_index
+from md5_check import file_md5
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+def main():
+    ### Input parameters. ###
+    project_name = 'TCGA_SKCM'
+    output_folder = Path('C:/Repositories/Melanoma_TCGA/analysis/')
+    json_files = Path('C:/Repositories/Melanoma_TCGA/data/files.2023-06-01.json')
+    json_cases = Path('C:/Repositories/Melanoma_TCGA/data/cases.2023-06-01.json')
+    # Manifest of the new snapshot.
+    new_manifest = Path('C:/Repositories/Melanoma_TCGA/data/gdc_manifest_20230601.txt')
+    # Folder for the delta manifest and superseded files.
+    download_folder = Path('C:/Repositories/Melanoma_TCGA/data/0601_delta/')
+    # Same rename rules as "file_sorter.py".
+    files_re_list_0 = ['*.PDF',
+                       '*_RPPA_data.tsv']
+    files_re_list_1 = ['*.wxs.aliquot_ensemble_masked.maf.gz',
+                       '*.rna_seq.augmented_star_gene_counts.tsv',
+                       '*.mirbase21.isoforms.quantification.txt',
+                       '*.mirbase21.mirnas.quantification.txt']
+    files_re_list_2 = ['*.gene_level_copy_number.v36.tsv']
+    rename_rules = [(files_re_list_0, None),
+                    (files_re_list_1, 1),
+                    (files_re_list_2, 2)]
+    # Main data with all cases' information.
+    main_data = Path('C:/Repositories/Melanoma_TCGA/data/clinical_patient_skcm.txt')
+    stage_colname = 'ajcc_pathologic_tumor_stage'
+    barcode_colname = 'bcr_patient_barcode'
+
+
+    project_folder = output_folder / replace_special_chars(project_name)
+    download_folder.mkdir(parents = True, exist_ok = True)
+    metadata_index = load_metadata_index(json_files, json_cases,
+                                         verbose = True)
+
+    ### Inventory of the sorted files. ###
+    inventory = read_inventory(project_folder)
+    if inventory is None:
+        print(f'## No inventory found, rebuilding from "{project_folder}"...')
+        inventory = rebuild_inventory(project_folder, metadata_index,
+                                      rename_rules)
+        write_inventory(project_folder, inventory)
+    print(f'Number of sorted files: {len(inventory)}')
+
+
+    ### Diff the new manifest against the inventory. ###
+    manifest = pd.read_table(new_manifest, dtype = str,
+                             keep_default_na = False)
+    if 'state' in manifest.columns:
+        manifest = manifest[manifest['state'] != 'annotation']
+    new_files, changed, removed = diff_manifest(manifest, inventory)
+    print(f'New files: {len(new_files)}, changed files: {len(changed)}, '
+          f'no longer in manifest: {len(removed)}')
+    delta = manifest[manifest['id'].isin(new_files) |
+                     manifest['id'].isin(changed['file_id'])]
+    delta_file = download_folder / 'gdc_manifest_delta.txt'
+    delta.to_csv(delta_file, sep = '\t', index = False)
+    print(f'Writing file: "{delta_file}" with {len(delta)} files...')
+    removed.to_csv(download_folder / 'removed_files.txt',
+                   sep = '\t', index = False)
+
+    # Move superseded versions out, so the new ones keep the names.
+    if len(changed):
+        superseded_folder = create_folder('superseded', download_folder,
+                                          verbose = True)
+        for row in changed.itertuples():
+            old_path = project_folder / row.stage / row.barcode / row.file_name
+            if old_path.exists():
+                shutil.move(old_path, superseded_folder / row.file_name)
+        inventory = inventory[~inventory['file_id'].isin(changed['file_id'])]
+
+
+    ### Move cases whose tumor stage changed. ###
+    main_df = pd.read_table(main_data, sep = '\t',
+                            header = 0, skiprows = [1,2])
+    barcode_stage = build_barcode_stage(main_df, barcode_colname,
+                                        stage_colname)
+    inventory = relocate_cases(project_folder, barcode_stage, inventory)
+    write_inventory(project_folder, inventory)
+
+
+def diff_manifest(manifest, inventory):
+    """Compare a GDC manifest with the inventory by file_id and md5.
+
+    :param manifest: The manifest with "id" and "md5" columns.
+    :type manifest: DataFrame
+    :param inventory: The inventory of sorted files.
+    :type inventory: DataFrame
+    :return: file_id of new files, inventory rows of changed files,
+        inventory rows of files not in the manifest.
+    :rtype: tuple
+    """
+    known = inventory[inventory['file_id'] != '']
+    known_md5 = dict(zip(known['file_id'], known['md5']))
+    manifest_md5 = dict(zip(manifest['id'], manifest['md5']))
+    new_files = [file_id for file_id in manifest_md5
+                 if file_id not in known_md5]
+    changed_ids = {file_id for file_id, md5 in manifest_md5.items()
+                   if file_id in known_md5 and known_md5[file_id] != md5}
+    changed = known[known['file_id'].isin(changed_ids)]
+    removed = known[~known['file_id'].isin(manifest_md5)]
+    return new_files, changed, removed
+
+
+def relocate_cases(project_folder, barcode_stage, inventory):
+    """Move "<stage>/<barcode>" folders to the current stage of the case.
+
+    :param project_folder: The project folder.
+    :type project_folder: Path
+    :param barcode_stage: Dictionary of barcode -> stage folder name.
+    :type barcode_stage: dict
+    :param inventory: The inventory of sorted files.
+    :type inventory: DataFrame
+    :return: The inventory with updated stages.
+    :rtype: DataFrame
+    """
+    moved = {}
+    for stage_folder in list(project_folder.iterdir()):
+        if not stage_folder.is_dir():
+            continue
+        for case_folder in list(stage_folder.iterdir()):
+            new_stage = barcode_stage.get(case_folder.name)
+            if new_stage is None or new_stage == stage_folder.name:
+                continue
+            target = project_folder / new_stage / case_folder.name
+            if target.exists() and any(target.iterdir()):
+                print(f'Warning: "{target}" is not empty, '
+                      f'keeping "{case_folder}"')
+                continue
+            print(f'Moving case "{case_folder.name}": '
+                  f'"{stage_folder.name}" -> "{new_stage}"')
+            os.makedirs(target.parent, exist_ok = True)
+            if target.exists():
+                target.rmdir()
+            os.rename(case_folder, target)
+            moved[case_folder.name] = new_stage
+    print(f'Number of cases moved to a new stage: {len(moved)}')
+    if moved:
+        inventory = inventory.copy()
+        new_stage = inventory['barcode'].map(moved)
+        inventory['stage'] = new_stage.fillna(inventory['stage'])
+    return inventory
+
+
+def rebuild_inventory(project_folder, metadata_index, rename_rules):
+    """Rebuild the inventory of a project sorted without one,
+    by matching sorted file names back to names in files json.
+    Files with several candidates are matched by md5,
+    unmatched files get an empty file_id.
+
+    :param project_folder: The project folder.
+    :type project_folder: Path
+    :param metadata_index: Index of files json and cases json.
+    :type metadata_index: MetadataIndex
+    :param rename_rules: See "file_sorter.resolve_target_name".
+    :type rename_rules: list
+    :return: The inventory.
+    :rtype: DataFrame
+    """
+    # Sorted name -> original names.
+    candidates = {}
+    for original_name in metadata_index.file_info:
+        new_name = resolve_target_name(original_name, metadata_index,
+                                       rename_rules, warn = False)
+        if new_name is not None:
+            candidates.setdefault(new_name, []).append(original_name)
+    rows = []
+    unmatched = 0
+    for file_path in sorted(project_folder.glob('*/*/*')):
+        if not file_path.is_file():
+            continue
+        name = file_path.name
+        # Decompressed files were matched with ".gz".
+        names = candidates.get(name, []) + candidates.get(name + '.gz', [])
+        original_name = None
+        if len(names) == 1:
+            original_name = names[0]
+        elif names:
+            md5 = file_md5(file_path)
+            found = [n for n in names if metadata_index.md5(n) == md5]
+            if len(found) == 1:
+                original_name = found[0]
+        if original_name is None:
+            unmatched += 1
+            rows.append(('', '', '', file_path.parents[1].name,
+                         file_path.parent.name, name))
+        else:
+            rows.append((metadata_index.file_id(original_name),
+                         metadata_index.md5(original_name), original_name,
+                         file_path.parents[1].name,
+                         file_path.parent.name, name))
+    print(f'Number of files not matched to files json: {unmatched}')
+    return pd.DataFrame(rows, columns = INVENTORY_COLUMNS)
+
+
+if __name__ == '__main__':
+    main()
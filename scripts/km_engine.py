@@ -0,0 +1,281 @@
+'''
+Kaplan-Meier and log-rank engine for many groupings at once.
+A grouping matrix has one row for each sample and one column for each
+grouping (high/low expression of a gene, the stages...), samples not in a
+group are -1 (or nan in a DataFrame). All groupings share one sorted
+event time axis: the at risk and death counts of every group are one
+matrix product of the group memberships with the sample time bins.
+For each grouping, the survival curves and median survival of its groups
+and the log-rank test across its groups are computed with array operations.
+Curves of selected groupings can be saved as SVG or PDF.
+'''
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from file_sorter import create_folder, replace_special_chars
+from expression_store import ExpressionStore, STORE_NAME
+from clinical import STAGE_NUMBER, merge_stages, read_clinical, \
+                     stage_number, survival_data
+from stage_scan import bh_fdr
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+def main():
+    ### Input parameters. ###
+    project_name = 'TCGA_SKCM'
+    output_folder = Path('C:/Repositories/Melanoma_TCGA/analysis/')
+    project_folder = output_folder / project_name
+    # Main data with all cases' information.
+    main_data = Path('C:/Repositories/Melanoma_TCGA/data/clinical_patient_skcm.txt')
+    # The columns we want.
+    columns_main = ['bcr_patient_barcode', 'vital_status',
+                    'last_contact_days_to', 'death_days_to',
+                    'ajcc_tumor_pathologic_pt', 'ajcc_nodes_pathologic_pn',
+                    'ajcc_metastasis_pathologic_pm']
+    # Each gene is split in high (>= quantile) and low groups.
+    measure = 'tpm_unstranded'
+    split_quantile = 0.5
+    # Groupings to plot, and the plot format: 'svg', 'pdf' or None.
+    plot_columns = ['tumor_stage', 'stage_M']
+    plot_format = 'svg'
+    block_size = 2000
+
+    store_folder = project_folder / STORE_NAME
+    if not (store_folder / 'sources.json').exists():
+        print(f'Error: No expression store in "{project_folder}", '
+              f'please run "gene_search.py" with search_mode "store".')
+        return
+    store = ExpressionStore(store_folder)
+    analysis_name = f'{replace_special_chars(project_name)}_analysis'
+    analysis_folder = create_folder(analysis_name, output_folder,
+                                    verbose = True)
+    km_folder = create_folder('kaplan_meier', analysis_folder,
+                              verbose = True)
+
+    ### Survival data of the samples (columns) in the store. ###
+    df_main = merge_stages(read_clinical(main_data, columns_main))
+    df_surv = survival_data(df_main).join(df_main.drop(
+                  columns = ['vital_status', 'last_contact_days_to',
+                             'death_days_to']))
+    df_surv = store.samples[['case_id', 'tumor_stage']].join(
+                  df_surv, on = 'case_id', how = 'inner')
+    df_surv = merge_stages(df_surv)
+    print(f'Cases with survival data: {len(df_surv)}')
+
+    ### Groupings: the stages, then high/low of each gene. ###
+    df_stages = pd.DataFrame(index = df_surv.index)
+    for stratifier in STAGE_NUMBER:
+        # Only the stages with a number, not "[Not Available]", "TX"...
+        stages = df_surv[stratifier]
+        df_stages[stratifier] = stages.where(
+            stage_number(stages, stratifier).notna().to_numpy())
+    codes, labels = grouping_codes(df_stages)
+    km = KaplanMeier(df_surv['days'], df_surv['vital_status'])
+    results = [km.fit(codes, labels, list(df_stages.columns))]
+
+    matrix = store.matrix(measure)
+    columns = df_surv.index.to_numpy()
+    for start in range(0, matrix.shape[0], block_size):
+        block = np.asarray(matrix[start:start + block_size][:, columns],
+                           dtype = np.float64)
+        cutoff = np.quantile(block, split_quantile, axis = 1,
+                             keepdims = True)
+        results.append(km.fit(
+            (block >= cutoff).T.astype(np.int8), [['low', 'high']],
+            store.genes['gene_name'].iloc[start:start + block_size].tolist()))
+        print(f'Kaplan-Meier: {min(start + block_size, matrix.shape[0])}'
+              f'/{matrix.shape[0]} genes')
+
+    df_logrank = pd.concat([result.logrank() for result in results],
+                           ignore_index = True)
+    df_logrank['fdr'] = np.nan
+    genes = df_logrank.index >= len(df_stages.columns)
+    df_logrank.loc[genes, 'fdr'] = bh_fdr(df_logrank.loc[genes, 'p'].
+                                          to_numpy())
+    df_median = pd.concat([result.medians() for result in results],
+                          ignore_index = True)
+    logrank_file = km_folder / f'logrank_{measure}.txt'
+    print(f'Writing file: "{logrank_file}"...')
+    df_logrank.to_csv(logrank_file, sep = '\t', index = False)
+    median_file = km_folder / f'median_survival_{measure}.txt'
+    print(f'Writing file: "{median_file}"...')
+    df_median.to_csv(median_file, sep = '\t', index = False)
+
+    if plot_format:
+        for column in plot_columns:
+            for result in results:
+                if column in result.columns:
+                    plot_file = km_folder / \
+                        f'km_{replace_special_chars(column)}.{plot_format}'
+                    print(f'Writing file: "{plot_file}"...')
+                    plot_curves(result, column, plot_file)
+
+
+def grouping_codes(df_groups):
+    """Integer codes of a grouping DataFrame.
+
+    :param df_groups: Samples x groupings of group labels, nan for samples
+        not in a group. Categorical columns keep their category order.
+    :type df_groups: DataFrame
+    :return: Samples x groupings int codes (-1 not in a group), and the
+        labels of the codes of each grouping.
+    :rtype: tuple(ndarray, list)
+    """
+    codes = np.empty(df_groups.shape, dtype = np.int64)
+    labels = []
+    for i, column in enumerate(df_groups.columns):
+        values = df_groups[column]
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype('category')
+        values = values.cat.remove_unused_categories()
+        codes[:, i] = values.cat.codes.to_numpy()
+        labels.append(list(values.cat.categories))
+    return codes, labels
+
+
+class KaplanMeier:
+    """Samples on one sorted event time axis.
+
+    :param time: Survival time of each sample.
+    :type time: array-like
+    :param event: 1 for death, 0 for censored.
+    :type event: array-like
+    """
+    def __init__(self, time, event):
+        time = np.asarray(time, dtype = np.float64)
+        event = np.asarray(event).astype(bool)
+        self.times = np.unique(time[event])
+        # Bin of each sample: last event time <= its time, -1 before,
+        # samples censored before the first event time are never at risk.
+        bins = np.searchsorted(self.times, time, side = 'right') - 1
+        n_times = len(self.times)
+        self.leaves = np.zeros((len(time), n_times + 1))
+        self.leaves[np.arange(len(time)), bins + 1] = 1
+        self.leaves = self.leaves[:, 1:]
+        self.deaths = self.leaves * event[:, None]
+
+    def fit(self, codes, labels, columns):
+        """Curves and counts of all the groups of many groupings.
+
+        :param codes: Samples x groupings int codes, -1 not in a group.
+        :type codes: ndarray
+        :param labels: Labels of the codes of each grouping, or one list
+            for all groupings.
+        :type labels: list
+        :param columns: Names of the groupings.
+        :type columns: list
+        :return: The fitted groupings.
+        :rtype: KaplanMeierResult
+        """
+        codes = np.asarray(codes)
+        if len(labels) == 1 and codes.shape[1] > 1:
+            labels = labels * codes.shape[1]
+        n_groups = max(len(group_labels) for group_labels in labels)
+        # Groupings x groups x samples memberships.
+        member = (codes.T[:, None, :] ==
+                  np.arange(n_groups)[None, :, None]).astype(np.float64)
+        # Samples leaving the risk set at each time, then the at risk
+        # counts as cumulative sums from the last time.
+        leaves = member @ self.leaves
+        at_risk = np.cumsum(leaves[..., ::-1], axis = -1)[..., ::-1]
+        deaths = member @ self.deaths
+        return KaplanMeierResult(self.times, list(columns), labels,
+                                 member.sum(axis = -1), at_risk, deaths)
+
+
+class KaplanMeierResult:
+    """Curves and log-rank tests of groupings fitted by "KaplanMeier".
+
+    :param times: Event times.
+    :param columns: Names of the groupings.
+    :param labels: Labels of the groups of each grouping.
+    :param cases: Groupings x groups number of samples.
+    :param at_risk: Groupings x groups x times samples at risk.
+    :param deaths: Groupings x groups x times deaths.
+    """
+    def __init__(self, times, columns, labels, cases, at_risk, deaths):
+        self.times = times
+        self.columns = columns
+        self.labels = labels
+        self.cases = cases
+        self.at_risk = at_risk
+        self.deaths = deaths
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            hazard = np.where(at_risk > 0, deaths / at_risk, 0)
+        self.survival = np.cumprod(1 - hazard, axis = -1)
+
+    def medians(self):
+        """Return cases, deaths and median survival (first time with
+        survival <= 0.5, nan if never reached) of each group."""
+        below = self.survival <= 0.5
+        first = below.argmax(axis = -1)
+        median = np.where(below.any(axis = -1),
+                          self.times[first] if len(self.times) else np.nan,
+                          np.nan)
+        rows = [(column, label, int(self.cases[c, g]),
+                 int(self.deaths[c, g].sum()),
+                 median[c, g])
+                for c, column in enumerate(self.columns)
+                for g, label in enumerate(self.labels[c])]
+        return pd.DataFrame(rows, columns = ['grouping', 'group', 'cases',
+                                             'deaths', 'median_survival'])
+
+    def logrank(self):
+        """Return the log-rank test across the groups of each grouping:
+        groups (with samples), chi2, df and p."""
+        n_all = self.at_risk.sum(axis = 1, keepdims = True)
+        d_all = self.deaths.sum(axis = 1, keepdims = True)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            share = np.where(n_all > 0, self.at_risk / n_all, 0)
+            weight = np.where(n_all > 1, d_all * (n_all - d_all) /
+                              (n_all - 1), 0)
+        # Observed - expected deaths, and their covariance over groups.
+        u = (self.deaths - d_all * share).sum(axis = -1)
+        n_groups = share.shape[1]
+        v = np.einsum('ct,cgt,gh->cgh', weight[:, 0], share,
+                      np.eye(n_groups)) - \
+            np.einsum('ct,cgt,cht->cgh', weight[:, 0], share, share)
+        # U sums to 0 and V is singular, the pseudo inverse gives the
+        # usual statistic of the groups minus one.
+        statistic = np.einsum('cg,cgh,ch->c', u, np.linalg.pinv(v), u)
+        groups = (self.cases > 0).sum(axis = 1)
+        df = np.maximum(groups - 1, 0)
+        with np.errstate(invalid = 'ignore'):
+            p = np.where(df > 0, chi2.sf(statistic, np.maximum(df, 1)),
+                         np.nan)
+        return pd.DataFrame({'grouping': self.columns, 'groups': groups,
+                             'chi2': np.where(df > 0, statistic, np.nan),
+                             'df': df, 'p': p})
+
+
+def plot_curves(result, column, save_path):
+    """Save the Kaplan-Meier curves of a grouping, the format is set by
+    the extension of "save_path", e.g. ".svg" or ".pdf"."""
+    c = result.columns.index(column)
+    times = np.concatenate(([0], result.times))
+    fig, ax = plt.subplots()
+    try:
+        for g, label in enumerate(result.labels[c]):
+            if result.cases[c, g] == 0:
+                continue
+            survival = np.concatenate(([1], result.survival[c, g]))
+            ax.step(times, survival, where = 'post',
+                    label = f'{label} (n={int(result.cases[c, g])})')
+        ax.set_xlabel('days')
+        ax.set_ylabel('survival probability')
+        ax.set_ylim(0, 1.05)
+        ax.set_title(column)
+        ax.legend()
+        fig.tight_layout()
+        fig.savefig(save_path)
+    finally:
+        plt.close(fig)
+
+
+if __name__ == '__main__':
+    main()
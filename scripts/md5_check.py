@@ -0,0 +1,204 @@
+'''
+Verify files against the md5 in the GDC manifest or files json.
+Files are hashed in parallel while streaming, verified files are
+cached by (path, size, mtime) so they are not hashed again.
+The hash can also be computed while a file is extracted or
+decompressed with "HashingReader", so the data is read only once.
+
+Run on its own to verify a sorted project with its inventory.
+'''
+import os
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from file_inventory import read_inventory
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+REPORT_COLUMNS = ['file', 'expected_md5', 'md5', 'expected_size', 'size',
+                  'status']
+
+def main():
+    ### Input parameters. ###
+    project_name = 'TCGA_SKCM'
+    output_folder = Path('C:/Repositories/Melanoma_TCGA/analysis/')
+    project_folder = output_folder / project_name
+    workers = 4
+
+    inventory = read_inventory(project_folder)
+    if inventory is None:
+        print(f'Error: No inventory in "{project_folder}", '
+              f'please run "file_sorter.py" or "incremental_sort.py".')
+        return
+    # Decompressed files no longer match the md5 of the download.
+    same_file = ~(inventory['original_name'].str.endswith('.gz') &
+                  ~inventory['file_name'].str.endswith('.gz'))
+    inventory = inventory[same_file & (inventory['md5'] != '')]
+    expected = {project_folder / row.stage / row.barcode / row.file_name:
+                (row.md5, None) for row in inventory.itertuples()}
+    report = verify_files(expected, workers = workers,
+                          cache_path = project_folder / 'md5_cache.sqlite')
+    write_report(report, project_folder / 'md5_report.tsv')
+
+
+class HashingReader:
+    """File-like wrapper updating an md5 with every byte read.
+
+    :param stream: The binary file object to read.
+    :type stream: file object
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.md5 = hashlib.md5()
+        self.bytes_read = 0
+
+    def read(self, size = -1):
+        data = self.stream.read(size)
+        self.md5.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def file_md5(file_path, chunk_size = 1 << 20):
+    """Return the md5 hex digest of a file, read in chunks."""
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def check_status(expected_md5, md5, expected_size = None, size = None):
+    """Return "pass", "size_mismatch" or "md5_mismatch"."""
+    if expected_size is not None and size is not None \
+       and int(expected_size) != int(size):
+        return 'size_mismatch'
+    if expected_md5 != md5:
+        return 'md5_mismatch'
+    return 'pass'
+
+
+def verify_files(expected, workers = 4, cache_path = None,
+                 chunk_size = 1 << 20):
+    """Hash files in parallel and compare with the expected md5 and size.
+
+    :param expected: Dictionary of file path -> (md5, size),
+        size None to skip the size check.
+    :type expected: dict
+    :param workers: Number of threads, defaults to 4
+    :type workers: int, optional
+    :param cache_path: SQLite file of verified files, defaults to None
+    :type cache_path: Path or str, optional
+    :param chunk_size: Bytes to read each time, defaults to 1 MiB
+    :type chunk_size: int, optional
+    :return: Per file pass/fail table.
+    :rtype: DataFrame
+    """
+    cache = Md5Cache(cache_path) if cache_path is not None else None
+    rows = []
+    to_hash = []
+    for file_path, (expected_md5, expected_size) in expected.items():
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            rows.append((str(file_path), expected_md5, None,
+                         expected_size, None, 'missing'))
+            continue
+        cached = cache.get(file_path, stat) if cache is not None else None
+        if cached is not None:
+            rows.append((str(file_path), expected_md5, cached,
+                         expected_size, stat.st_size,
+                         check_status(expected_md5, cached,
+                                      expected_size, stat.st_size)))
+        else:
+            to_hash.append((file_path, stat))
+
+    start = time.perf_counter()
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        md5s = executor.map(lambda item: file_md5(item[0], chunk_size),
+                            to_hash)
+        for (file_path, stat), md5 in zip(to_hash, md5s):
+            expected_md5, expected_size = expected[file_path]
+            status = check_status(expected_md5, md5,
+                                  expected_size, stat.st_size)
+            rows.append((str(file_path), expected_md5, md5,
+                         expected_size, stat.st_size, status))
+            total_bytes += stat.st_size
+            if cache is not None and status == 'pass':
+                cache.put(file_path, stat, md5)
+    if cache is not None:
+        cache.close()
+    seconds = max(time.perf_counter() - start, 1e-9)
+    report = pd.DataFrame(rows, columns = REPORT_COLUMNS)
+    print(f'Hashed {len(to_hash)} files, {total_bytes / 1e6:.1f} MB '
+          f'in {seconds:.1f} s ({total_bytes / 1e6 / seconds:.1f} MB/s), '
+          f'{len(expected) - len(to_hash)} skipped or cached')
+    return report
+
+
+def write_report(report, report_file):
+    """Write the pass/fail table and print a summary.
+
+    :param report: Per file pass/fail table.
+    :type report: DataFrame
+    :param report_file: Path to write the table.
+    :type report_file: Path or str
+    """
+    report.to_csv(report_file, sep = '\t', index = False)
+    counts = report['status'].value_counts()
+    print(f'Writing file: "{report_file}"...')
+    print(f'md5 check: {counts.get("pass", 0)} passed, '
+          f'{len(report) - counts.get("pass", 0)} failed')
+    failed = report[report['status'] != 'pass']
+    for row in failed.itertuples():
+        print(f'Warning: {row.status} for file "{row.file}"')
+
+
+class Md5Cache:
+    """SQLite cache of md5 of verified files, by (path, size, mtime).
+
+    :param cache_path: Path to the SQLite file.
+    :type cache_path: Path or str
+    """
+    def __init__(self, cache_path):
+        self.con = sqlite3.connect(cache_path, check_same_thread = False)
+        self.con.execute('CREATE TABLE IF NOT EXISTS verified '
+                         '(path TEXT PRIMARY KEY, size INTEGER, '
+                         'mtime INTEGER, md5 TEXT)')
+
+    def get(self, file_path, stat):
+        row = self.con.execute('SELECT md5 FROM verified WHERE path = ? '
+                               'AND size = ? AND mtime = ?',
+                               (str(file_path), stat.st_size,
+                                stat.st_mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def put(self, file_path, stat, md5):
+        self.con.execute('INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?)',
+                         (str(file_path), stat.st_size,
+                          stat.st_mtime_ns, md5))
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+
+if __name__ == '__main__':
+    main()
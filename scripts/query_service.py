@@ -0,0 +1,161 @@
+'''
+Local HTTP/JSON service for gene queries.
+Keeps the expression store (memory mapped) and the clinical table loaded,
+and answers on localhost:
+    GET /gene/<gene>: values of the gene for each case, with the stages.
+    GET /stats/<gene>: count, median, mean of the gene for each stage.
+    GET /health: number of genes and samples.
+<gene> is a gene_name or gene_id. Results of recent genes are kept
+in an LRU cache.
+
+Build the expression store first with "gene_search.py" (search_mode 'store').
+'''
+import json
+from pathlib import Path
+from functools import lru_cache
+from urllib.parse import unquote, urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from expression_store import ExpressionStore, STORE_NAME, MEASURES
+from clinical import read_clinical
+from stage_stats import stage_statistics
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+def main():
+    ### Input parameters. ###
+    project_name = 'TCGA_SKCM'
+    output_folder = Path('C:/Repositories/Melanoma_TCGA/analysis/')
+    project_folder = output_folder / project_name
+    # Main data with all cases' information.
+    main_data = Path('C:/Repositories/Melanoma_TCGA/data/clinical_patient_skcm.txt')
+    # The columns we want.
+    columns_main = ['bcr_patient_barcode', 'ajcc_tumor_pathologic_pt',
+                    'ajcc_nodes_pathologic_pn', 'ajcc_metastasis_pathologic_pm']
+    # Only serve on this machine.
+    host = '127.0.0.1'
+    port = 8765
+    # Number of genes kept in the result cache.
+    cache_size = 256
+
+    store_folder = project_folder / STORE_NAME
+    if not (store_folder / 'sources.json').exists():
+        print(f'Error: No expression store in "{project_folder}", '
+              f'please run "gene_search.py" with search_mode "store".')
+        return
+    query = GeneQuery(ExpressionStore(store_folder),
+                      read_clinical(main_data, columns_main),
+                      cache_size = cache_size)
+    serve(query, host = host, port = port)
+
+
+class GeneQuery:
+    """Gene queries on the expression store and the clinical table,
+    results as JSON bytes, cached for the "cache_size" latest genes.
+
+    :param store: The expression store.
+    :type store: ExpressionStore
+    :param df_main: Clinical table indexed by barcode, see
+        "clinical.read_clinical".
+    :type df_main: DataFrame
+    :param measures: Measures to return, defaults to tpm, fpkm, fpkm_uq
+    :type measures: list, optional
+    :param cache_size: Number of genes in the cache, defaults to 256
+    :type cache_size: int, optional
+    """
+    def __init__(self, store, df_main, measures = MEASURES[1:],
+                 cache_size = 256):
+        self.store = store
+        self.df_main = df_main
+        self.measures = list(measures)
+        self.gene_json = lru_cache(maxsize = cache_size)(self._gene_json)
+        self.stats_json = lru_cache(maxsize = cache_size)(self._stats_json)
+
+    def gene_frame(self, gene):
+        """Values of the gene joined with the stages, None if not found."""
+        if not self.store.gene_rows(gene):
+            return None
+        df_gene = self.store.gene_frame(gene, self.measures)
+        df_gene = df_gene.rename_axis('gene').reset_index()
+        return df_gene.join(self.df_main, on = 'case_id', how = 'inner')
+
+    def _gene_json(self, gene):
+        df_gene = self.gene_frame(gene)
+        if df_gene is None:
+            return None
+        return df_gene.to_json(orient = 'records').encode()
+
+    def _stats_json(self, gene):
+        df_gene = self.gene_frame(gene)
+        if df_gene is None:
+            return None
+        df_stats = stage_statistics(df_gene, self.measures,
+                                    gene_column = 'gene')
+        return df_stats.to_json(orient = 'records').encode()
+
+    def health_json(self):
+        return json.dumps({'genes': len(self.store.genes),
+                           'samples': len(self.store.samples),
+                           'cache': self.gene_json.cache_info()._asdict()}
+                          ).encode()
+
+
+def make_handler(query):
+    """Return a request handler class answering with "query"."""
+    routes = {'gene': query.gene_json, 'stats': query.stats_json}
+
+    class GeneQueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = urlparse(self.path).path.strip('/').split('/', 1)
+            if parts == ['health']:
+                self._send(200, query.health_json())
+            elif len(parts) == 2 and parts[0] in routes:
+                body = routes[parts[0]](unquote(parts[1]))
+                if body is None:
+                    self._send(404, json.dumps(
+                        {'error': f'gene "{unquote(parts[1])}" not found'}
+                        ).encode())
+                else:
+                    self._send(200, body)
+            else:
+                self._send(404, json.dumps(
+                    {'error': 'use /gene/<gene>, /stats/<gene> or /health'}
+                    ).encode())
+
+        def _send(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Keep the console quiet, one line per request is too much.
+            pass
+
+    return GeneQueryHandler
+
+
+def serve(query, host = '127.0.0.1', port = 8765):
+    """Serve gene queries until interrupted.
+
+    :param query: The gene queries.
+    :type query: GeneQuery
+    :param host: Address to listen on, defaults to '127.0.0.1'
+    :type host: str, optional
+    :param port: Port to listen on, defaults to 8765
+    :type port: int, optional
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(query))
+    print(f'## Serving gene queries on "http://{host}:{port}/", '
+          f'Ctrl+C to stop...')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
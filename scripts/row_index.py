@@ -0,0 +1,266 @@
+'''
+Row index of the STAR gene count files, for reading a few genes
+without parsing the whole file.
+All count files share the same gene order, so the line number of each
+gene is taken once from a reference file. The byte offset of every line
+of each file is found once by scanning the file for newlines, and kept
+in a SQLite file keyed by (path, size, mtime). A lookup then seeks and
+reads only the header and the lines of the genes.
+The header and the gene_id at each offset are checked against the
+reference: stale offsets are rescanned, and a file whose layout differs
+is parsed in full instead.
+'''
+import io
+import mmap
+import sqlite3
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+OFFSETS_NAME = 'row_offsets.sqlite'
+
+
+class RowIndex:
+    """Line numbers of the genes in the reference count file.
+
+    :param reference_file: A STAR gene count file.
+    :type reference_file: Path or str
+    :param offsets_path: SQLite file of the line offsets, defaults to
+        ':memory:' to keep them only while the index is open
+    :type offsets_path: Path or str, optional
+    """
+    def __init__(self, reference_file, offsets_path = ':memory:'):
+        self.reference_file = reference_file
+        self.offsets = LineOffsets(offsets_path)
+        lines = read_lines(reference_file)
+        # Comment lines, e.g. "# gene-model: GENCODE v36", then the header.
+        self.header_line = next(i for i, line in enumerate(lines)
+                                if not line.startswith(b'#'))
+        self.header = lines[self.header_line]
+        columns = self.header.decode().rstrip('\r\n').split('\t')
+        id_pos, name_pos = columns.index('gene_id'), columns.index('gene_name')
+        # gene_id or gene_name -> line numbers.
+        self.lines = {}
+        for number in range(self.header_line + 1, len(lines)):
+            fields = lines[number].decode().split('\t')
+            self.lines.setdefault(fields[id_pos], []).append(number)
+            if fields[name_pos]:
+                self.lines.setdefault(fields[name_pos], []).append(number)
+        self.id_pos = id_pos
+        # line number -> gene_id, to validate other files.
+        self.line_gene = {numbers[0]: gene for gene, numbers
+                          in self.lines.items() if gene.startswith(
+                          ('ENSG', 'N_')) and len(numbers) == 1}
+
+    def gene_lines(self, genes):
+        """Return the sorted line numbers of the genes."""
+        return sorted({n for gene in genes for n in self.lines.get(gene, [])})
+
+    def read_genes(self, file_path, genes, usecols):
+        """Read the lines of the genes in one file.
+
+        :param file_path: A STAR gene count file.
+        :type file_path: Path or str
+        :param genes: The gene_name or gene_id to read.
+        :type genes: list or set
+        :param usecols: Columns to read, the gene column first.
+        :type usecols: list
+        :return: The rows, None if the file layout differs.
+        :rtype: DataFrame or None
+        """
+        numbers = self.gene_lines(genes) + [self.header_line]
+        lines = read_at(file_path, self.offsets.get(file_path), numbers)
+        if not self._valid(numbers, lines):
+            # Offsets of a file rewritten with the same size and mtime.
+            offsets = self.offsets.get(file_path, rescan = True)
+            lines = read_at(file_path, offsets, numbers)
+            if not self._valid(numbers, lines):
+                return None
+        text = b''.join([self.header] + lines[:-1])
+        df = pd.read_table(io.BytesIO(text), usecols = usecols,
+                           index_col = 0)
+        df.index.name = None    # Remove index name.
+        return df[df.index.isin(genes)]
+
+
+    def _valid(self, numbers, lines):
+        # Header, then the gene_id of each line, as in the reference.
+        if lines is None or lines[-1] != self.header:
+            return False
+        for number, line in zip(numbers, lines):
+            gene_id = line.split(b'\t')[self.id_pos].decode()
+            if self.line_gene.get(number, gene_id) != gene_id:
+                return False
+        return True
+
+    def close(self):
+        self.offsets.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LineOffsets:
+    """Byte offsets of the lines of each file, keyed by (path, size, mtime).
+
+    :param index_path: Path to the SQLite file, or ':memory:'.
+    :type index_path: Path or str
+    """
+    def __init__(self, index_path):
+        self.con = sqlite3.connect(index_path)
+        self.con.execute('CREATE TABLE IF NOT EXISTS offsets '
+                         '(path TEXT PRIMARY KEY, size INTEGER, '
+                         'mtime INTEGER, offsets BLOB)')
+
+    def get(self, file_path, rescan = False):
+        """Return the line starts of a file and its size at the end,
+        scanning the file if it is new, changed or "rescan" is True."""
+        path = str(Path(file_path))
+        stat = os.stat(file_path)
+        row = self.con.execute('SELECT size, mtime, offsets FROM offsets '
+                               'WHERE path = ?', (path,)).fetchone()
+        if not rescan and row is not None and \
+           tuple(row[:2]) == (stat.st_size, stat.st_mtime_ns):
+            return np.frombuffer(row[2], dtype = _offset_dtype(stat.st_size))
+        offsets = line_offsets(file_path)
+        # Committed on close, one transaction for all new files.
+        self.con.execute('INSERT OR REPLACE INTO offsets VALUES (?, ?, ?, ?)',
+                         (path, stat.st_size, stat.st_mtime_ns,
+                          offsets.astype(_offset_dtype(stat.st_size)).
+                          tobytes()))
+        return offsets
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+
+def _offset_dtype(size):
+    # 4 bytes for each line of files under 4 GiB.
+    return np.uint32 if size < 1 << 32 else np.uint64
+
+
+def line_offsets(file_path):
+    """Return the start of each line of a file, then the file size.
+
+    :param file_path: Path to the file.
+    :type file_path: Path or str
+    :return: int64 offsets, line "n" is bytes offsets[n]:offsets[n + 1].
+    :rtype: ndarray
+    """
+    with open(file_path, 'rb') as file:
+        try:
+            buffer = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files, or file systems without mmap.
+            buffer = file.read()
+        try:
+            data = np.frombuffer(buffer, dtype = np.uint8)
+            ends = np.flatnonzero(data == ord('\n')) + 1
+            del data
+            size = len(buffer)
+        finally:
+            if isinstance(buffer, mmap.mmap):
+                buffer.close()
+    if size and (not len(ends) or ends[-1] != size):
+        # Last line without a line ending.
+        ends = np.append(ends, size)
+    return np.concatenate(([0], ends)).astype(np.int64)
+
+
+def read_at(file_path, offsets, numbers):
+    """Read lines of a file by line number, seeking to their offsets.
+
+    :param file_path: Path to the file.
+    :type file_path: Path or str
+    :param offsets: Line offsets from "line_offsets".
+    :type offsets: ndarray
+    :param numbers: Line numbers to read.
+    :type numbers: list
+    :return: The lines with line endings, None if a line is past the end.
+    :rtype: list or None
+    """
+    if numbers and max(numbers) >= len(offsets) - 1:
+        return None
+    lines = []
+    with open(file_path, 'rb') as file:
+        for n in numbers:
+            file.seek(int(offsets[n]))
+            lines.append(file.read(int(offsets[n + 1] - offsets[n])))
+    return lines
+
+
+def read_lines(file_path, numbers = None):
+    """Read lines of a file by line number.
+
+    :param file_path: Path to the file.
+    :type file_path: Path or str
+    :param numbers: Line numbers to read, defaults to None for all lines
+    :type numbers: list, optional
+    :return: The lines with line endings, None if a line is past the end.
+    :rtype: list or None
+    """
+    offsets = line_offsets(file_path)
+    if numbers is None:
+        numbers = range(len(offsets) - 1)
+    elif numbers and max(numbers) >= len(offsets) - 1:
+        return None
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    return [data[offsets[n]:offsets[n + 1]] for n in numbers]
+
+
+def gene_lookup(files_list, gene, usecols, row_index = None,
+                offsets_path = ':memory:'):
+    """Search genes in each file through the row index,
+    same output as "gene_search.gene_search".
+
+    :param files_list: List of STAR gene count file paths.
+    :type files_list: list
+    :param gene: The gene, or a list or set of genes.
+    :type gene: str or list or set
+    :param usecols: Columns to read, the gene column first.
+    :type usecols: list
+    :param row_index: The row index, defaults to None
+        to build it from the first file.
+    :type row_index: RowIndex, optional
+    :param offsets_path: SQLite file of the line offsets, when the row
+        index is built here, defaults to ':memory:'
+    :type offsets_path: Path or str, optional
+    :return: Rows of all genes in all files, with "case_id" and "tumor_stage".
+    :rtype: DataFrame
+    """
+    genes = {gene} if isinstance(gene, str) else set(gene)
+    if not files_list:
+        return pd.DataFrame(columns = usecols[1:] +
+                            ['case_id', 'tumor_stage'])
+    close = row_index is None
+    if row_index is None:
+        row_index = RowIndex(files_list[0], offsets_path)
+    df_list = []
+    fallback = 0
+    for file in files_list:
+        df = row_index.read_genes(file, genes, usecols)
+        if df is None:
+            fallback += 1
+            print(f'Attention: Layout of "{file}" differs, parsing in full')
+            df = pd.read_table(file, usecols = usecols, index_col = 0,
+                               skiprows = row_index.header_line)
+            df.index.name = None
+            df = df[df.index.isin(genes)]
+        df = df.copy()
+        df['case_id'] = Path(file).parents[0].name
+        df['tumor_stage'] = Path(file).parents[1].name
+        df_list.append(df)
+    if close:
+        row_index.close()
+    if fallback:
+        print(f'Number of files parsed in full: {fallback}')
+    return pd.concat(df_list, axis=0, join='outer')
@@ -0,0 +1,205 @@
+'''
+Index of the STAR gene count files of a sorted project,
+to pick one canonical file for each case with duplicate files.
+Summary stats of each file (library size, detected genes, N_unmapped)
+and the aliquot barcode from files json are kept in a SQLite file,
+keyed by (path, size, mtime), so files are read only once.
+
+Selection policies:
+    "min_unmapped": smallest "N_unmapped" count, the original rule.
+    "highest_depth": largest library size.
+    "earliest_aliquot": smallest aliquot barcode.
+    "sample_type": TCGA sample type "01A" first, then "01B", "02A"...
+'''
+import os
+import re
+import sqlite3
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from file_inventory import read_inventory
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+INDEX_NAME = 'sample_index.sqlite'
+POLICIES = ['min_unmapped', 'highest_depth', 'earliest_aliquot',
+            'sample_type']
+# Sample type and vial of an aliquot barcode, e.g. "06A".
+SAMPLE_TYPE = re.compile(r'^TCGA-\w\w-\w{4}-(\d\d)([A-Z])')
+
+
+class SampleIndex:
+    """Summary stats and aliquot of each STAR gene count file.
+
+    :param index_path: Path to the SQLite file.
+    :type index_path: Path or str
+    """
+    def __init__(self, index_path):
+        self.index_path = Path(index_path)
+        self.con = sqlite3.connect(self.index_path)
+        self.con.execute('CREATE TABLE IF NOT EXISTS samples '
+                         '(path TEXT PRIMARY KEY, size INTEGER, '
+                         'mtime INTEGER, stage TEXT, barcode TEXT, '
+                         'aliquot TEXT, library_size INTEGER, '
+                         'detected_genes INTEGER, n_unmapped INTEGER)')
+        self.samples = None
+
+    def update(self, files_list, aliquots = None, workers = 4):
+        """Add new or changed files, drop files not in "files_list".
+
+        :param files_list: List of STAR gene count file paths
+            in "<project>/<stage>/<barcode>/".
+        :type files_list: list
+        :param aliquots: Dictionary of file name -> aliquot barcode,
+            defaults to None
+        :type aliquots: dict, optional
+        :param workers: Number of threads, defaults to 4
+        :type workers: int, optional
+        """
+        aliquots = aliquots or {}
+        cached = {row[0]: row[1:] for row in self.con.execute(
+                  'SELECT path, size, mtime FROM samples')}
+        stats = {str(Path(f)): os.stat(f) for f in files_list}
+        to_read = [path for path, stat in stats.items()
+                   if cached.get(path) != (stat.st_size, stat.st_mtime_ns)]
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            summaries = list(executor.map(count_summary, to_read))
+        with self.con:
+            self.con.executemany('DELETE FROM samples WHERE path = ?',
+                                 [(p,) for p in cached if p not in stats])
+            self.con.executemany(
+                'INSERT OR REPLACE INTO samples VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(path, stats[path].st_size, stats[path].st_mtime_ns,
+                  Path(path).parents[1].name, Path(path).parent.name,
+                  aliquots.get(Path(path).name)) + summary
+                 for path, summary in zip(to_read, summaries)])
+            if aliquots:
+                self.con.executemany(
+                    'UPDATE samples SET aliquot = ? WHERE path = ?',
+                    [(aliquots.get(Path(path).name), path) for path in stats])
+        print(f'Sample index: {len(to_read)} files read, '
+              f'{len(stats) - len(to_read)} cached')
+        self.samples = None
+
+    def table(self):
+        """Return all indexed files as a DataFrame."""
+        if self.samples is None:
+            self.samples = pd.read_sql('SELECT * FROM samples', self.con)
+        return self.samples
+
+    def select(self, policy = 'min_unmapped'):
+        """Pick one file for each case folder.
+
+        :param policy: One of "POLICIES", defaults to 'min_unmapped'
+        :type policy: str, optional
+        :return: Dictionary of "stage/barcode" -> file path,
+            and the list of file paths not selected.
+        :rtype: tuple
+        """
+        samples = self.table()
+        if policy == 'min_unmapped':
+            keys, ascending = ['n_unmapped'], [True]
+        elif policy == 'highest_depth':
+            keys, ascending = ['library_size'], [False]
+        elif policy == 'earliest_aliquot':
+            keys, ascending = ['aliquot'], [True]
+        elif policy == 'sample_type':
+            samples = samples.assign(sample_rank = samples['aliquot'].
+                                     map(sample_type_rank))
+            keys, ascending = ['sample_rank', 'library_size'], [True, False]
+        else:
+            raise ValueError(f'Unknown policy "{policy}", '
+                             f'expected one of {POLICIES}')
+        # Ties and missing values are settled by the path.
+        samples = samples.sort_values(keys + ['path'],
+                                      ascending = ascending + [True],
+                                      na_position = 'last')
+        samples = samples.assign(case_folder = samples['stage'] + '/' +
+                                 samples['barcode'])
+        first = samples.duplicated('case_folder')
+        canonical = dict(zip(samples.loc[~first, 'case_folder'],
+                             samples.loc[~first, 'path']))
+        removed = sorted(samples.loc[first, 'path'])
+        return canonical, removed
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def count_summary(file_path):
+    """Summary stats of a STAR gene count file.
+
+    :param file_path: Path to the file.
+    :type file_path: Path or str
+    :return: (library size, detected genes, N_unmapped) of "unstranded".
+    :rtype: tuple
+    """
+    df = pd.read_table(file_path, usecols = ['gene_id', 'unstranded'],
+                       index_col = 0, skiprows = 1)
+    counts = df['unstranded']
+    # "N_unmapped", "N_multimapping"... are not genes.
+    genes = counts[~counts.index.str.startswith('N_')]
+    n_unmapped = counts.get('N_unmapped', counts.iloc[0])
+    return int(genes.sum()), int((genes > 0).sum()), int(n_unmapped)
+
+
+def sample_type_rank(aliquot):
+    """Rank of an aliquot barcode by sample type then vial,
+    "01A" ranks first, None for unknown barcodes."""
+    if not isinstance(aliquot, str):
+        return None
+    match = SAMPLE_TYPE.match(aliquot)
+    if match is None:
+        return None
+    return int(match.group(1)) * 26 + ord(match.group(2)) - ord('A')
+
+
+def file_aliquots(project_folder, metadata_index):
+    """Aliquot barcode of each sorted file, from the inventory and files json.
+
+    :param project_folder: The project folder.
+    :type project_folder: Path
+    :param metadata_index: Index of files json and cases json.
+    :type metadata_index: MetadataIndex
+    :return: Dictionary of sorted file name -> aliquot barcode.
+    :rtype: dict
+    """
+    inventory = read_inventory(project_folder)
+    if inventory is None:
+        print(f'Attention: No inventory in "{project_folder}", '
+              f'aliquot barcodes not available')
+        return {}
+    return {row.file_name: metadata_index.aliquot(row.original_name)
+            for row in inventory.itertuples()}
+
+
+def load_sample_index(project_folder, files_list, metadata_index = None,
+                      workers = 4):
+    """Open the sample index of a project and bring it up to date.
+
+    :param project_folder: The project folder.
+    :type project_folder: Path
+    :param files_list: List of STAR gene count file paths.
+    :type files_list: list
+    :param metadata_index: Index of files json and cases json,
+        for the aliquot barcodes, defaults to None
+    :type metadata_index: MetadataIndex, optional
+    :param workers: Number of threads, defaults to 4
+    :type workers: int, optional
+    :return: The sample index.
+    :rtype: SampleIndex
+    """
+    aliquots = None
+    if metadata_index is not None:
+        aliquots = file_aliquots(project_folder, metadata_index)
+    index = SampleIndex(project_folder / INDEX_NAME)
+    index.update(files_list, aliquots = aliquots, workers = workers)
+    return index
@@ -0,0 +1,152 @@
+'''
+Append-only journal of the file operations done by "file_sorter.py",
+so a crashed run can be resumed without repeating completed steps.
+
+Each line is a json record of one operation ("move", "rename",
+"decompress", "write") or one finished step, with status "start" or
+"done". An operation counts as completed only if its "done" record
+exists and the destination still has the recorded size.
+'''
+import os
+import json
+import threading
+from pathlib import Path
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+class Journal:
+    """Operation journal of one file_sorter run.
+
+    :param journal_file: Path to the journal file.
+    :type journal_file: Path or str
+    :param resume: Load the existing journal and skip completed
+        operations, otherwise start a new journal, defaults to False
+    :type resume: bool, optional
+    """
+    def __init__(self, journal_file, resume = False):
+        self.journal_file = Path(journal_file)
+        self.resume = resume
+        self._lock = threading.Lock()
+        # (op, src) -> (dst, size) of completed operations.
+        self.done = {}
+        # Destination path -> op of completed operations.
+        self.produced = {}
+        self.steps = set()
+        if resume and self.journal_file.exists():
+            self._load()
+            print(f'## Resuming from "{self.journal_file}": '
+                  f'{len(self.done)} operations, '
+                  f'{len(self.steps)} steps completed')
+        self._file = open(self.journal_file, 'a' if resume else 'w')
+
+    def _load(self):
+        with open(self.journal_file) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line cut off by the crash.
+                    continue
+                if record['op'] == 'step':
+                    self.steps.add(record['name'])
+                elif record['status'] == 'done':
+                    self.done[(record['op'], record['src'])] = \
+                        (record['dst'], record['size'])
+                    self.produced[record['dst']] = record['op']
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def step_done(self, name):
+        """Return True if step "name" was completed."""
+        return name in self.steps
+
+    def mark_step(self, name):
+        """Record step "name" as completed."""
+        self.steps.add(name)
+        self._write({'op': 'step', 'name': name})
+
+    def is_produced(self, path, op):
+        """Return True if "path" is the destination of a completed
+        operation "op", i.e. the file is already processed."""
+        return self.produced.get(str(path)) == op
+
+    def outputs(self, op):
+        """Return {src: dst} of completed operations "op"."""
+        return {src: dst for (done_op, src), (dst, size) in self.done.items()
+                if done_op == op}
+
+    def is_done(self, op, src):
+        """Return the destination if operation "op" on "src" was
+        completed and its output is intact, otherwise None.
+
+        :param op: Operation name.
+        :type op: str
+        :param src: Source path.
+        :type src: Path or str
+        :return: The destination path or None.
+        :rtype: Path or None
+        """
+        record = self.done.get((op, str(src)))
+        if record is None:
+            return None
+        dst, size = record
+        # Folders are only checked for existence.
+        if size is None and os.path.isdir(dst):
+            return Path(dst)
+        try:
+            if os.path.isfile(dst) and os.path.getsize(dst) == size:
+                return Path(dst)
+        except OSError:
+            pass
+        print(f'Warning: Output "{dst}" of {op} is missing or partially '
+              f'written, redoing...')
+        return None
+
+    def run(self, op, src, dst, func):
+        """Run "func" for operation "op" from "src" to "dst"
+        unless it was completed, then record it.
+
+        :param op: Operation name.
+        :type op: str
+        :param src: Source path.
+        :type src: Path or str
+        :param dst: Destination path.
+        :type dst: Path or str
+        :param func: Function doing the operation.
+        :type func: callable
+        :return: True if the operation was run, False if skipped.
+        :rtype: bool
+        """
+        if self.resume:
+            if self.is_done(op, src) is not None:
+                return False
+            # Crashed after an atomic operation, before it was recorded.
+            if not os.path.exists(src) and os.path.exists(dst):
+                self.record(op, src, dst)
+                return False
+        self._write({'op': op, 'src': str(src), 'dst': str(dst),
+                     'status': 'start'})
+        func()
+        self.record(op, src, dst)
+        return True
+
+    def record(self, op, src, dst):
+        size = os.path.getsize(dst) if os.path.isfile(dst) else None
+        with self._lock:
+            self.done[(op, str(src))] = (str(dst), size)
+            self.produced[str(dst)] = op
+        self._write({'op': op, 'src': str(src), 'dst': str(dst),
+                     'status': 'done', 'size': size})
@@ -0,0 +1,177 @@
+'''
+Genome wide scan of expression changes across stages.
+For every gene in the expression store and each stratifier
+("tumor_stage", "stage_T", "stage_N", "stage_M"), compute the
+median and mean for each stage and the Kruskal-Wallis test,
+with Benjamini-Hochberg FDR over all genes of the stratifier.
+Genes are processed in blocks, so memory stays bounded.
+
+Build the expression store first with "gene_search.py" (search_mode 'store').
+'''
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata, chi2
+from file_sorter import create_folder, replace_special_chars
+from expression_store import ExpressionStore, STORE_NAME
+from clinical import STRATIFIERS, merge_stages, read_clinical
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+# Stages left out of the tests.
+EXCLUDE_STAGES = ['_Not_Available_', 'I_II_NOS', '[Not Available]',
+                  '[Discrepancy]', 'TX', 'Tis', 'NX']
+
+def main():
+    ### Input parameters. ###
+    project_name = 'TCGA_SKCM'
+    output_folder = Path('C:/Repositories/Melanoma_TCGA/analysis/')
+    project_folder = output_folder / project_name
+    # Main data with all cases' information.
+    main_data = Path('C:/Repositories/Melanoma_TCGA/data/clinical_patient_skcm.txt')
+    # The columns we want.
+    columns_main = ['bcr_patient_barcode', 'ajcc_tumor_pathologic_pt',
+                    'ajcc_nodes_pathologic_pn', 'ajcc_metastasis_pathologic_pm']
+    # Measure of the expression store to test.
+    measure = 'tpm_unstranded'
+    # Merge sub-stages, e.g. "T1a", "T1b" into "T1".
+    merge = True
+    # Stages with fewer cases are left out.
+    min_cases = 3
+    # Genes for each block.
+    block_size = 2000
+
+    store_folder = project_folder / STORE_NAME
+    if not (store_folder / 'sources.json').exists():
+        print(f'Error: No expression store in "{project_folder}", '
+              f'please run "gene_search.py" with search_mode "store".')
+        return
+    store = ExpressionStore(store_folder)
+    analysis_name = f'{replace_special_chars(project_name)}_analysis'
+    analysis_folder = create_folder(analysis_name, output_folder,
+                                    verbose = True)
+    scan_folder = create_folder('stage_scan', analysis_folder,
+                                verbose = True)
+
+    # Read main_data into DataFrame.
+    df_main = read_clinical(main_data, columns_main)
+
+    # Stages of each sample (column) of the store.
+    df_stage = store.samples.join(df_main, on = 'case_id')[STRATIFIERS]
+    if merge:
+        df_stage = merge_stages(df_stage)
+
+    for stratifier in STRATIFIERS:
+        print(f'## Scanning {len(store.genes)} genes for "{stratifier}"...')
+        df_scan = stage_scan(store.matrix(measure), df_stage[stratifier],
+                             block_size = block_size, min_cases = min_cases)
+        df_scan = pd.concat([store.genes[['gene_id', 'gene_name']],
+                             df_scan], axis = 1)
+        df_scan = df_scan.sort_values('p_value', na_position = 'last')
+        scan_file = scan_folder / f'stage_scan_{stratifier}_{measure}.txt'
+        print(f'Writing file: "{scan_file}"...')
+        df_scan.to_csv(scan_file, sep = '\t', index = False)
+        print(f'Genes with FDR < 0.05: {(df_scan["fdr"] < 0.05).sum()}')
+
+
+def stage_scan(matrix, stages, block_size = 2000, min_cases = 3,
+               exclude = EXCLUDE_STAGES):
+    """Per stage median and mean and Kruskal-Wallis test of every gene.
+
+    :param matrix: Genes x samples values, e.g. a memory map.
+    :type matrix: ndarray
+    :param stages: Stage of each sample (column).
+    :type stages: Series
+    :param block_size: Genes for each block, defaults to 2000
+    :type block_size: int, optional
+    :param min_cases: Stages with fewer cases are left out, defaults to 3
+    :type min_cases: int, optional
+    :param exclude: Stages left out, defaults to "EXCLUDE_STAGES"
+    :type exclude: list, optional
+    :return: One row for each gene (row of "matrix"): "median_<stage>",
+        "mean_<stage>", "H", "p_value" and "fdr".
+    :rtype: DataFrame
+    """
+    stages = pd.Series(stages).reset_index(drop = True)
+    stages = stages[stages.notna() & ~stages.isin(exclude)]
+    counts = stages.value_counts()
+    stages = stages[stages.isin(counts[counts >= min_cases].index)]
+    grouped = stages.groupby(stages, observed = True).groups
+    groups = {stage: np.flatnonzero(stages.index.isin(index))
+              for stage, index in grouped.items()}
+    columns = stages.index.to_numpy()
+    n_genes = matrix.shape[0]
+    result = {}
+    for stage in groups:
+        result[f'median_{stage}'] = np.empty(n_genes)
+        result[f'mean_{stage}'] = np.empty(n_genes)
+    h_stat = np.full(n_genes, np.nan)
+    for start in range(0, n_genes, block_size):
+        end = min(start + block_size, n_genes)
+        block = np.asarray(matrix[start:end][:, columns], dtype = np.float64)
+        for stage, index in groups.items():
+            result[f'median_{stage}'][start:end] = np.median(block[:, index],
+                                                             axis = 1)
+            result[f'mean_{stage}'][start:end] = block[:, index].mean(axis = 1)
+        if len(groups) > 1:
+            h_stat[start:end] = kruskal_wallis(block, groups.values())
+    df_scan = pd.DataFrame(result)
+    df_scan['cases'] = len(columns)
+    df_scan['stages'] = len(groups)
+    df_scan['H'] = h_stat
+    df_scan['p_value'] = chi2.sf(h_stat, len(groups) - 1)
+    df_scan['fdr'] = bh_fdr(df_scan['p_value'].to_numpy())
+    return df_scan
+
+
+def kruskal_wallis(block, groups):
+    """Kruskal-Wallis H of each row, with tie correction,
+    nan for rows with one value only.
+
+    :param block: Genes x samples values.
+    :type block: ndarray
+    :param groups: Column numbers of each group.
+    :type groups: iterable
+    :return: H of each row.
+    :rtype: ndarray
+    """
+    n = block.shape[1]
+    ranks = rankdata(block, axis = 1)
+    h_stat = np.zeros(block.shape[0])
+    for index in groups:
+        index = np.asarray(index)
+        h_stat += ranks[:, index].sum(axis = 1) ** 2 / len(index)
+    h_stat = 12 / (n * (n + 1)) * h_stat - 3 * (n + 1)
+    # Tie correction: sum of (t^3 - t) over the tied groups of each row.
+    values = np.sort(block, axis = 1)
+    starts = np.ones_like(values, dtype = bool)
+    starts[:, 1:] = values[:, 1:] != values[:, :-1]
+    tie_sum = np.zeros(block.shape[0])
+    rows, cols = np.nonzero(starts)
+    # Length of each run of equal values, runs in row order.
+    ends = np.append(cols[1:], n)
+    ends[np.append(rows[1:] != rows[:-1], True)] = n
+    t = (ends - cols).astype(np.float64)
+    np.add.at(tie_sum, rows, t ** 3 - t)
+    correction = 1 - tie_sum / (n ** 3 - n)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(correction > 0, h_stat / correction, np.nan)
+
+
+def bh_fdr(p_values):
+    """Benjamini-Hochberg adjusted p-values, nan stays nan."""
+    p_values = np.asarray(p_values, dtype = np.float64)
+    fdr = np.full_like(p_values, np.nan)
+    valid = np.flatnonzero(~np.isnan(p_values))
+    order = valid[np.argsort(p_values[valid])]
+    m = len(order)
+    adjusted = p_values[order] * m / np.arange(1, m + 1)
+    # Keep the adjusted p-values monotonic, from the largest p down.
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+    fdr[order] = np.minimum(adjusted, 1)
+    return fdr
+
+
+if __name__ == '__main__':
+    main()
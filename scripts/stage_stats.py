@@ -0,0 +1,69 @@
+'''
+Count, median and mean of expression values for each stage,
+for every stratifier ("tumor_stage", "stage_T", "stage_N", "stage_M"),
+every variant (raw, "0" removed, stages merged, both)
+and every gene, in one groupby over a long table.
+'''
+import pandas as pd
+from clinical import STRATIFIERS, merge_stages
+
+__author__ = "Johnathan Lin <jagonball@gmail.com>"
+__email__ = "jagonball@gmail.com"
+
+VARIANTS = ['raw', 'rm0', 'merge', 'merge_rm0']
+STATS_COLUMNS = ['gene', 'variant', 'stratifier', 'stratum', 'measure',
+                 'cases', 'median', 'mean']
+
+
+def remove_zeros(df, value_columns):
+    """Return the rows of "df" without "0" in any of "value_columns"."""
+    return df[(df[value_columns] != 0).all(axis = 1)]
+
+
+def stage_statistics(df, value_columns, stratifiers = STRATIFIERS,
+                     gene_column = None):
+    """Count, median and mean of each value column for each stage.
+
+    :param df: One row for each case (and gene), with the value columns
+        and the stratifier columns.
+    :type df: DataFrame
+    :param value_columns: Columns of expression values.
+    :type value_columns: list
+    :param stratifiers: Columns of stages, defaults to "STRATIFIERS"
+    :type stratifiers: list, optional
+    :param gene_column: Column of gene names for many genes,
+        defaults to None for the index.
+    :type gene_column: str, optional
+    :return: Tidy table with "STATS_COLUMNS", "cases" is the
+        number of rows in the stage, as "groupby().size()".
+    :rtype: DataFrame
+    """
+    if gene_column is None:
+        genes = pd.Series(df.index, index = df.index).astype(str)
+    else:
+        genes = df[gene_column].astype(str)
+    df = df[value_columns + stratifiers].assign(gene = genes.to_numpy())
+    merged = merge_stages(df)
+    variants = {'raw': df,
+                'rm0': remove_zeros(df, value_columns),
+                'merge': merged,
+                'merge_rm0': remove_zeros(merged, value_columns)}
+    long = pd.concat(variants, names = ['variant', None]).\
+              reset_index(level = 0)
+    long = long.melt(id_vars = ['gene', 'variant'] + value_columns,
+                     value_vars = stratifiers,
+                     var_name = 'stratifier', value_name = 'stratum')
+    long = long.melt(id_vars = ['gene', 'variant', 'stratifier', 'stratum'],
+                     value_vars = value_columns,
+                     var_name = 'measure', value_name = 'value')
+    # Keep the order of variants, stratifiers and measures in the output.
+    long['variant'] = pd.Categorical(long['variant'], VARIANTS)
+    long['stratifier'] = pd.Categorical(long['stratifier'], stratifiers)
+    long['measure'] = pd.Categorical(long['measure'], value_columns)
+    stats = long.groupby(['gene', 'variant', 'stratifier', 'stratum',
+                          'measure'], observed = True)['value'].\
+                 agg(cases = 'size', median = 'median', mean = 'mean')
+    stats = stats.reset_index()[STATS_COLUMNS]
+    for column in ['variant', 'stratifier', 'measure']:
+        stats[column] = stats[column].astype(str)
+    return stats
@@ -7,6 +7,9 @@ import pandas as pd
 import numpy as np
 from lifelines import CoxPHFitter
 from file_sorter import create_folder
+from clinical import read_clinical, stage_number, survival_data
+from content_store import file_sha256
+from analysis_cache import AnalysisCache, CACHE_NAME, input_key
 
 __author__ = "Johnathan Lin <jagonball@gmail.com>"
 __email__ = "jagonball@gmail.com"
@@ -30,31 +33,20 @@ def main():
     survival_folder = create_folder('survival', gene_folder,
                                    verbose = True)
 
-    # Read main_data into DataFrame.
-    main_df = pd.read_table(main_data, sep = '\t', header = 0,
-                            index_col = 'bcr_patient_barcode',
-                            usecols = columns_main, skiprows = [1,2])
-    #print(main_df.shape)
-    #print(main_df.head())
-    new_df = main_df[main_df['vital_status'] == 'Alive'].copy()
-    #print(new_df.shape)
-    # Remove rows without proper value.
-    new_df = new_df[~new_df['last_contact_days_to'].str.startswith('[')]
-    #print(new_df.shape)
-    #print(new_df.head())
-    temp_df = main_df[main_df['vital_status'] == 'Dead'].copy()
-    #print(temp_df.shape)
-    # Remove rows without proper value.
-    temp_df = temp_df[~temp_df['death_days_to'].str.startswith('[')]
-    #print(temp_df.shape)
-
-    # Rename column to 'days' then concat DataFrame.
-    new_df = new_df.rename(columns={'last_contact_days_to': 'days'})
-    temp_df = temp_df.rename(columns={'death_days_to': 'days'})
-    new_df = pd.concat([new_df, temp_df], axis=0, join='outer')
-    # Drop the unwanted columns.
-    new_df = new_df.drop(columns=['last_contact_days_to', 'death_days_to'])
-    new_df = new_df.replace({'Alive': 0, 'Dead': 1})
+    # Skip the model if the gene file and main_data are unchanged.
+    output_file = survival_folder / 'CoxPHFitter.txt'
+    cache = AnalysisCache(gene_folder.parent / CACHE_NAME)
+    key = input_key('CoxPHFitter', target_gene, file_sha256(gene_file),
+                    file_sha256(main_data), columns_main)
+    if cache.is_current([output_file], key):
+        print(f'Up to date: "{output_file}"')
+        cache.close()
+        return
+
+    # Read main_data into DataFrame, "[Not Available]" days as nan.
+    main_df = read_clinical(main_data, columns_main)
+    # Days to death for "Dead", days to last contact for "Alive".
+    new_df = survival_data(main_df)
     print(new_df.shape)
     #print(new_df.head(-5))
     # Save file to check.
@@ -111,43 +103,11 @@ def main():
     print(new_df.shape)
     #print(new_df.head(-5))
 
-    # Dictionary for stage rename.
-    tumor_stage = {'Stage_0': 0,
-                   'Stage_I': 1,
-                   'Stage_II': 2,
-                   'Stage_III': 3,
-                   'Stage_IV': 4,
-                   '_Not_Available_': np.nan,
-                   'I_II_NOS': np.nan}
-
-    # All stages: '[Not Available]', 'T0', 'T1~4', 'Tis', 'TX'.
-    stage_T = {'T0': 0,
-               'T1': 1,
-               'T2': 2,
-               'T3': 3,
-               'T4': 4,
-               '[Not Available]': np.nan,
-               'TX': np.nan,
-               'Tis': np.nan}
-
-    # All stages: '[Not Available]', 'N0', 'N1~3', 'NX'.
-    stage_N = {'N0': 0,
-               'N1': 1,
-               'N2': 2,
-               'N3': 3,
-               '[Not Available]': np.nan,
-               'NX': np.nan}
-
-    # All stages: '[Not Available]', 'M0', 'M1'.
-    stage_M = {'M0': 0,
-               'M1': 1,
-               '[Not Available]': np.nan}
-
-    # Stage rename then dropna.
-    #new_df['tumor_stage'] = new_df['tumor_stage'].replace(tumor_stage)
-    #new_df['stage_T'] = new_df['stage_T'].replace(stage_T)
-    #new_df['stage_N'] = new_df['stage_N'].replace(stage_N)
-    new_df['stage_M'] = new_df['stage_M'].replace(stage_M)
+    # Stage numbers, see "clinical.STAGE_NUMBER", then dropna.
+    #new_df['tumor_stage'] = stage_number(new_df['tumor_stage'], 'tumor_stage')
+    #new_df['stage_T'] = stage_number(new_df['stage_T'], 'stage_T')
+    #new_df['stage_N'] = stage_number(new_df['stage_N'], 'stage_N')
+    new_df['stage_M'] = stage_number(new_df['stage_M'], 'stage_M')
     new_df = new_df.dropna()
     #print(new_df.shape)
     #print(new_df.head(-5))
@@ -174,6 +134,8 @@ def main():
         sys.stdout = f # Change the standard output to the file we created.
         cph.print_summary()
         sys.stdout = original_stdout # Reset the standard output to its original value.
+    cache.record([output_file], key)
+    cache.close()
 
 
 if __name__ == '__main__':